@@ -0,0 +1,55 @@
+"""Entorno aislado para los benchmarks: HOME temporal (DB, master key y cache de
+media propios) para no tocar los datos reales, e import de server.py desde ahí.
+
+server.py importa el router de Gemini desde ~/gemini-router.py al cargar. Si existe
+el real se copia al HOME temporal; si no, se escribe uno mínimo (los benchmarks no
+llaman al LLM)."""
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_ROUTER_MIN = '''class GeminiRouter:
+    keys = []
+    rpd_counts = {}
+
+    def ask_chat(self, messages, system="", timeout=30):
+        return {"ok": False, "error": "router de benchmark"}
+
+    def status_json(self):
+        return {}
+'''
+
+
+def bench_home(tag, keep=False):
+    """Crea (o reusa, con keep=True) un HOME para el benchmark y lo activa."""
+    home = os.path.join(tempfile.gettempdir(), f"lola-bench-{tag}")
+    if not keep and os.path.isdir(home):
+        shutil.rmtree(home)
+    os.makedirs(home, exist_ok=True)
+    router = os.path.join(home, "gemini-router.py")
+    if not os.path.exists(router):
+        real = os.path.expanduser("~/gemini-router.py")
+        if os.path.exists(real):
+            shutil.copy(real, router)
+        else:
+            with open(router, "w") as f:
+                f.write(_ROUTER_MIN)
+    os.environ["HOME"] = home
+    return home
+
+
+def import_server(quiet=True):
+    """Importa server.py del repo (después de bench_home y de setear las LOLA_*)."""
+    sys.path.insert(0, REPO)
+    if not quiet:
+        import server
+        return server
+    with contextlib.redirect_stdout(io.StringIO()):
+        import server
+    return server
@@ -0,0 +1,66 @@
+"""Benchmark del pool HTTP keep-alive contra la Graph API falsa (fake_graph.py).
+
+    python bench/bench_http.py [N]
+
+Compara N POSTs abriendo una conexión TCP+TLS por request (como hacía
+urllib.request.urlopen) contra _wa_typing_now, que usa el pool de server.py, y
+cuenta los handshakes que vio el server. Después chequea la descarga de media con
+y sin redirect: el body de un 3xx nunca se toma como el archivo."""
+
+import os
+import sys
+import time
+import urllib.request
+
+from _env import bench_home, import_server
+from fake_graph import FakeGraph
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    with FakeGraph() as fg:
+        bench_home("http")
+        os.environ["LOLA_GRAPH_BASE"] = fg.base
+        os.environ["LOLA_MEDIA_CACHE_MB"] = "0"
+        server = import_server()
+        server._http_ssl_ctx.load_verify_locations(fg.cafile)
+        wa_ctx = {"phone_number_id": "1", "access_token": "t"}
+
+        ctx = fg.client_context()
+        fg.reset_stats()
+        t0 = time.perf_counter()
+        for _ in range(n):
+            req = urllib.request.Request(f"{fg.base}/1/messages", data=b"{}", method="POST",
+                                         headers={"Content-Type": "application/json"})
+            with urllib.request.urlopen(req, context=ctx) as resp:
+                resp.read()
+        fresh_ms = (time.perf_counter() - t0) / n * 1000
+        fresh_handshakes = fg.stats["connections"]
+
+        fg.reset_stats()
+        t0 = time.perf_counter()
+        for _ in range(n):
+            status = server._wa_typing_now("598", "wamid.in", wa_ctx)
+            assert status == 200, status
+        pooled_ms = (time.perf_counter() - t0) / n * 1000
+        pooled_handshakes = fg.stats["connections"]
+
+        print(f"{n} POSTs a /messages")
+        print(f"  conexión por request: {fresh_ms:.2f} ms/req, {fresh_handshakes} handshakes")
+        print(f"  keep-alive (server):  {pooled_ms:.2f} ms/req, {pooled_handshakes} handshakes")
+        print(f"  métricas del pool: {server._http_metrics()}")
+
+        data = os.urandom(256 * 1024)
+        fg.add_media("directo", data)
+        fg.add_media("redirigido", data, redirect=True)
+        for media_id in ("directo", "redirigido"):
+            media = server._wa_download_media(media_id, wa_ctx)
+            assert media is not None, media_id
+            with media:
+                got = media.read()
+            assert got == data, f"{media_id}: {len(got)} bytes, esperados {len(data)}"
+            print(f"  media {media_id}: {len(got)} bytes ok")
+
+
+if __name__ == "__main__":
+    main()
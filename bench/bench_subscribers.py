@@ -0,0 +1,69 @@
+"""Benchmark del chequeo de suscripción por teléfono con N subscribers.
+
+    python bench/bench_subscribers.py [N]      # default 50000
+
+- antes: _db_subscribers_load() (desencripta toda la tabla) + búsqueda lineal por
+  los últimos 8 dígitos, como hacía _mp_check_subscription antes del índice
+- índice: _mp_check_subscription, que busca por phone_suffix_hash
+
+Usa un HOME temporal propio (se reusa entre corridas para no repoblar)."""
+
+import re
+import sqlite3
+import sys
+import time
+
+from _env import bench_home, import_server
+
+REPS_OLD = 3
+REPS_NEW = 2000
+
+
+def _populate(server, n):
+    with sqlite3.connect(server._DB_PATH) as conn:
+        have = conn.execute("SELECT COUNT(*) FROM subscribers").fetchone()[0]
+    if have >= n:
+        return
+    subs = {
+        f"user{i}@example.com": {
+            "plan": "basico", "status": "authorized", "mp_id": f"mp{i}",
+            "phone": "5989%07d" % i, "updated": "",
+        }
+        for i in range(n)
+    }
+    if not server._db_subscribers_save(subs).wait(timeout=600):
+        raise SystemExit("no se pudieron guardar los subscribers")
+
+
+def _old_check(server, phone):
+    """El chequeo de antes: toda la tabla desencriptada y un scan por sufijo."""
+    suffix = re.sub(r"\D", "", phone)[-8:]
+    for email, info in server._db_subscribers_load().items():
+        if re.sub(r"\D", "", info.get("phone", ""))[-8:] == suffix:
+            return {"found": True, "plan": info.get("plan"), "status": info.get("status"), "email": email}
+    return {"found": False}
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    bench_home(f"subs{n}", keep=True)
+    server = import_server()
+    _populate(server, n)
+    phones = ["5989%07d" % (n - 1 - i % n) for i in range(REPS_NEW)]
+
+    t0 = time.perf_counter()
+    for phone in phones[:REPS_OLD]:
+        old = _old_check(server, phone)
+    old_ms = (time.perf_counter() - t0) / REPS_OLD * 1000
+
+    t0 = time.perf_counter()
+    for phone in phones:
+        new = server._mp_check_subscription(phone)
+    new_ms = (time.perf_counter() - t0) / REPS_NEW * 1000
+
+    assert old["found"] and new["found"], (old, new)
+    print(f"subscribers={n}: antes {old_ms:.1f} ms/chequeo | índice {new_ms:.3f} ms/chequeo")
+
+
+if __name__ == "__main__":
+    main()
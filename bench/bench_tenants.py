@@ -0,0 +1,115 @@
+"""Benchmark del camino de DB de un webhook de WhatsApp con N tenants.
+
+    python bench/bench_tenants.py            # 1000 y 10000 tenants
+    python bench/bench_tenants.py 10000      # uno solo
+
+Por mensaje se resuelve el número (wa_numbers) y su tenant (tenants), como hace el
+webhook. Se mide:
+- antes: una conexión nueva por consulta, con PRAGMA journal_mode=WAL y bajo un
+  lock global (lo que hacía _db_conn() antes del pool)
+- pool: _db_wa_number_load + _db_tenant_load_by_hash con el cache de tenants frío
+- pool + cache: lo mismo con el tenant ya en _tenant_cache
+- ruta: _wa_route, la tabla de routing en memoria que usa hoy el webhook
+
+Cada N usa su propio HOME temporal (se reusa entre corridas para no repoblar)."""
+
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+from _env import bench_home, import_server
+
+LOOKUPS = 2000
+
+
+def _populate(server, n):
+    """Inserta n tenants con su número de WhatsApp (encriptados como los guarda server.py)."""
+    with sqlite3.connect(server._DB_PATH) as conn:
+        have = conn.execute("SELECT COUNT(*) FROM wa_numbers").fetchone()[0]
+        if have >= n:
+            return
+        enc = server._encrypt
+        prompt = enc("Sos el asistente de un negocio. " * 60)
+        now = time.strftime("%Y-%m-%d %H:%M")
+        tenants, numbers = [], []
+        for i in range(n):
+            phone = "5989%07d" % i
+            ph = server._hash_key(phone)
+            tenants.append((ph, enc(phone), enc(f"t{i}@example.com"), "basico",
+                            enc('{"nombre_negocio": "Negocio %d"}' % i), prompt, now, now))
+            numbers.append((f"pnid{i}", ph, enc(f"token{i}"), "", f"Negocio {i}", "active", now, now))
+        conn.executemany(
+            "INSERT OR REPLACE INTO tenants (phone_hash, phone, email, plan, business_data, system_prompt, "
+            "created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", tenants)
+        conn.executemany(
+            "INSERT OR REPLACE INTO wa_numbers (phone_number_id, tenant_phone_hash, access_token, "
+            "business_account_id, label, status, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", numbers)
+
+
+def _old_path(server, lock, pnid):
+    """El camino de antes del pool: abrir, PRAGMA, consultar, cerrar (dos veces)."""
+    def query(sql, params):
+        with lock:
+            conn = sqlite3.connect(server._DB_PATH)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            try:
+                return conn.execute(sql, params).fetchone()
+            finally:
+                conn.close()
+    row = query("SELECT * FROM wa_numbers WHERE phone_number_id = ? AND status = 'active'", (pnid,))
+    server._decrypt(row["access_token"])
+    row = query("SELECT * FROM tenants WHERE phone_hash = ?", (row["tenant_phone_hash"],))
+    for field in ("phone", "email", "business_data", "system_prompt"):
+        server._decrypt(row[field])
+
+
+def _time_us(fn, ids):
+    t0 = time.perf_counter()
+    for pnid in ids:
+        fn(pnid)
+    return (time.perf_counter() - t0) / len(ids) * 1e6
+
+
+def run(n):
+    bench_home(f"tenants{n}", keep=True)
+    server = import_server()
+    _populate(server, n)
+    server._wa_routes_rebuild()
+    rnd = random.Random(n)
+    ids = [f"pnid{rnd.randrange(n)}" for _ in range(LOOKUPS)]
+    lock = threading.Lock()
+
+    def pooled(pnid):
+        number = server._db_wa_number_load(pnid)
+        return server._db_tenant_load_by_hash(number["tenant_phone_hash"])
+
+    def pooled_cold(pnid):
+        server._tenant_cache.clear()
+        return pooled(pnid)
+
+    old = _time_us(lambda pnid: _old_path(server, lock, pnid), ids)
+    cold = _time_us(pooled_cold, ids)
+    pooled(ids[0])
+    warm_ids = [ids[0]] * LOOKUPS
+    warm = _time_us(pooled, warm_ids)
+    route = _time_us(server._wa_route, ids)
+    print(f"tenants={n}: antes {old:.0f} us/msg | pool {cold:.0f} us/msg | "
+          f"pool + cache {warm:.0f} us/msg | ruta {route:.1f} us/msg")
+
+
+def main():
+    if len(sys.argv) > 1:
+        run(int(sys.argv[1]))
+        return
+    # Un proceso por N: server.py fija su HOME (DB, master key) al importarse
+    for n in (1000, 10000):
+        subprocess.run([sys.executable, os.path.abspath(__file__), str(n)], check=True)
+
+
+if __name__ == "__main__":
+    main()
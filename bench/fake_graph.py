@@ -0,0 +1,170 @@
+"""Graph API falsa y local (HTTPS en 127.0.0.1) para medir y probar el cliente HTTP
+de server.py sin pegarle a graph.facebook.com.
+
+    from fake_graph import FakeGraph
+    with FakeGraph() as fg:
+        os.environ["LOLA_GRAPH_BASE"] = fg.base   # antes de importar server
+        ...
+        server._http_ssl_ctx.load_verify_locations(fg.cafile)
+
+Responde lo mínimo que usa server.py:
+- POST /<id>/messages → {"messages": [{"id": "wamid.N"}]} (envíos, typing, reacciones)
+- GET /<media_id> → metadata con la URL de descarga
+- GET /files/<media_id> → los bytes; con add_media(..., redirect=True) responde
+  302 a /cdn/<media_id>, como el CDN de Meta.
+
+Cuenta conexiones TCP+TLS aceptadas (handshakes) y requests, para comparar el
+cliente con keep-alive contra uno que abre una conexión por request."""
+
+import datetime
+import ipaddress
+import json
+import os
+import shutil
+import ssl
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+
+def _self_signed(dirpath):
+    """Certificado autofirmado para 127.0.0.1. Retorna (cert_path, key_path)."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "fake-graph.local")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = os.path.join(dirpath, "cert.pem")
+    key_path = os.path.join(dirpath, "key.pem")
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, addr, handler, graph):
+        super().__init__(addr, handler)
+        self.graph = graph
+
+    def get_request(self):
+        sock, addr = super().get_request()
+        with self.graph._lock:
+            self.graph.stats["connections"] += 1
+        return sock, addr
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # sin esto Nagle + delayed ACK suman ~40 ms por request
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, status, data):
+        self._send(status, json.dumps(data).encode("utf-8"), {"Content-Type": "application/json"})
+
+    def do_POST(self):
+        graph = self.server.graph
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with graph._lock:
+            graph.stats["posts"] += 1
+            n = graph.stats["posts"]
+        if self.path.endswith("/messages"):
+            self._json(200, {"messaging_product": "whatsapp", "messages": [{"id": f"wamid.fake{n}"}]})
+        else:
+            self._json(404, {"error": {"message": "no existe"}})
+
+    def do_GET(self):
+        graph = self.server.graph
+        with graph._lock:
+            graph.stats["gets"] += 1
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if len(parts) == 2 and parts[0] in ("files", "cdn"):
+            media = graph.media.get(parts[1])
+            if media is None:
+                self._json(404, {"error": {"message": "media no existe"}})
+            elif parts[0] == "files" and media["redirect"]:
+                self._send(302, b"redirect", {"Location": f"/cdn/{parts[1]}"})
+            else:
+                self._send(200, media["data"], {"Content-Type": media["mime_type"]})
+            return
+        media = graph.media.get(parts[-1])
+        if media is None:
+            self._json(404, {"error": {"message": "media no existe"}})
+            return
+        self._json(200, {
+            "url": f"{graph.origin}/files/{parts[-1]}",
+            "mime_type": media["mime_type"],
+            "file_size": len(media["data"]),
+            "id": parts[-1],
+        })
+
+
+class FakeGraph:
+    """Graph API falsa en un thread. base = URL para LOLA_GRAPH_BASE; cafile = cert
+    autofirmado para confiar en ella."""
+
+    def __init__(self, version="v23.0"):
+        self._dir = tempfile.mkdtemp(prefix="fake-graph-")
+        self.cafile, keyfile = _self_signed(self._dir)
+        self._lock = threading.Lock()
+        self.stats = {"connections": 0, "posts": 0, "gets": 0}
+        self.media = {}
+        self._srv = _Server(("127.0.0.1", 0), _Handler, self)
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(self.cafile, keyfile)
+        self._srv.socket = ctx.wrap_socket(self._srv.socket, server_side=True)
+        self.origin = f"https://127.0.0.1:{self._srv.server_address[1]}"
+        self.base = f"{self.origin}/{version}"
+        threading.Thread(target=self._srv.serve_forever, name="fake-graph", daemon=True).start()
+
+    def add_media(self, media_id, data, mime_type="audio/ogg", redirect=False):
+        self.media[media_id] = {"data": data, "mime_type": mime_type, "redirect": redirect}
+
+    def client_context(self):
+        """SSLContext de cliente que confía en el cert de la Graph falsa."""
+        return ssl.create_default_context(cafile=self.cafile)
+
+    def reset_stats(self):
+        with self._lock:
+            for k in self.stats:
+                self.stats[k] = 0
+
+    def close(self):
+        self._srv.shutdown()
+        self._srv.server_close()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
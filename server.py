@@ -14,20 +14,37 @@ import os
 import json
 import random
 import base64
+import contextlib
 import hashlib
+import heapq
 import hmac
+import http.client
+import queue
 import re
+import select
 import sqlite3
 import shlex
+import shutil
+import ssl
 import subprocess
+import tempfile
 import threading
 import time
+import unicodedata
 import urllib.request
 import urllib.error
 from http.server import HTTPServer, ThreadingHTTPServer, SimpleHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs
+from collections import OrderedDict, deque, namedtuple
+from types import MappingProxyType
+from urllib.parse import urlparse, parse_qs, urljoin
 
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
+
+# Opcional: achicar fotos antes de mandarlas al LLM (sin Pillow se mandan tal cual)
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
 
 # Importar el router
 sys.path.insert(0, os.path.expanduser("~"))
@@ -41,7 +58,37 @@ router = GeminiRouter()
 
 _DB_PATH = os.path.expanduser("~/.lola-db.sqlite")
 _MASTER_KEY_PATH = os.path.expanduser("~/.lola-master.key")
-_db_lock = threading.Lock()
+# WAL permite lectores concurrentes con un solo escritor: las lecturas no toman
+# lock, las escrituras se serializan con _db_write_lock.
+_db_write_lock = threading.Lock()
+
+# Pool de conexiones SQLite: se reusan en vez de abrir/cerrar una por llamada.
+# sqlite3 cachea los statements preparados por conexión (cached_statements),
+# así que reusar la conexión también reusa los prepared statements.
+_DB_POOL_SIZE = int(os.environ.get("LOLA_DB_POOL_SIZE", "8"))
+_DB_STMT_CACHE = 128
+
+# Perfil de pragmas por conexión. synchronous=NORMAL es seguro en WAL (se puede
+# perder la última transacción ante un corte de luz, no corrompe la DB).
+_DB_PRAGMAS = {
+    "synchronous": os.environ.get("LOLA_DB_SYNCHRONOUS", "NORMAL"),
+    "cache_size": int(os.environ.get("LOLA_DB_CACHE_KB", "8192")) * -1,  # negativo = KiB
+    "mmap_size": int(os.environ.get("LOLA_DB_MMAP_MB", "64")) * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+_db_pool = queue.LifoQueue(maxsize=_DB_POOL_SIZE)
+_db_pool_stats = {"opened": 0, "closed": 0, "checkouts": 0, "reused": 0}
+_db_pool_stats_lock = threading.Lock()
+
+# Métricas de contención: espera por el lock de escritura y lectores en paralelo
+_db_lock_stats = {
+    "writes": 0,
+    "write_wait_total_ms": 0.0,
+    "write_wait_max_ms": 0.0,
+    "reads": 0,
+    "reads_in_flight": 0,
+    "reads_in_flight_max": 0,
+}
 
 
 def _load_or_create_master_key():
@@ -136,196 +183,862 @@ def _require_admin(handler):
     return False
 
 
-def _db_conn():
-    """Crea una conexión a SQLite con WAL mode."""
-    conn = sqlite3.connect(_DB_PATH, timeout=10)
+def _db_new_conn():
+    """Abre una conexión nueva a SQLite y aplica los PRAGMAs una sola vez."""
+    conn = sqlite3.connect(
+        _DB_PATH, timeout=10, check_same_thread=False,
+        cached_statements=_DB_STMT_CACHE,
+    )
     conn.execute("PRAGMA journal_mode=WAL")
+    for name, value in _DB_PRAGMAS.items():
+        conn.execute(f"PRAGMA {name}={value}")
     conn.row_factory = sqlite3.Row
+    with _db_pool_stats_lock:
+        _db_pool_stats["opened"] += 1
     return conn
 
 
+@contextlib.contextmanager
+def _db_conn():
+    """Presta una conexión del pool (o abre una si está vacío) y la devuelve al salir.
+    Las conexiones se reusan entre threads: ThreadingHTTPServer crea un thread por
+    request, así que un pool thread-local abriría una conexión nueva igual."""
+    try:
+        conn = _db_pool.get_nowait()
+        reused = True
+    except queue.Empty:
+        conn = _db_new_conn()
+        reused = False
+    with _db_pool_stats_lock:
+        _db_pool_stats["checkouts"] += 1
+        if reused:
+            _db_pool_stats["reused"] += 1
+    try:
+        yield conn
+    finally:
+        # No devolver al pool una conexión con una transacción a medias
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            _db_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+            with _db_pool_stats_lock:
+                _db_pool_stats["closed"] += 1
+
+
+@contextlib.contextmanager
+def _db_read():
+    """Conexión para lecturas. No toma lock: en WAL los lectores no bloquean al escritor."""
+    with _db_pool_stats_lock:
+        _db_lock_stats["reads"] += 1
+        _db_lock_stats["reads_in_flight"] += 1
+        if _db_lock_stats["reads_in_flight"] > _db_lock_stats["reads_in_flight_max"]:
+            _db_lock_stats["reads_in_flight_max"] = _db_lock_stats["reads_in_flight"]
+    try:
+        with _db_conn() as conn:
+            yield conn
+    finally:
+        with _db_pool_stats_lock:
+            _db_lock_stats["reads_in_flight"] -= 1
+
+
+@contextlib.contextmanager
+def _db_write():
+    """Conexión para escrituras, serializadas por _db_write_lock. Mide la espera del lock."""
+    t0 = time.perf_counter()
+    with _db_write_lock:
+        waited_ms = (time.perf_counter() - t0) * 1000
+        with _db_pool_stats_lock:
+            _db_lock_stats["writes"] += 1
+            _db_lock_stats["write_wait_total_ms"] += waited_ms
+            if waited_ms > _db_lock_stats["write_wait_max_ms"]:
+                _db_lock_stats["write_wait_max_ms"] = waited_ms
+        with _db_conn() as conn:
+            yield conn
+
+
+def _db_metrics():
+    """Snapshot de métricas del pool y del lock de escritura."""
+    with _db_pool_stats_lock:
+        lock = dict(_db_lock_stats)
+        pool = dict(_db_pool_stats)
+    pool["idle"] = _db_pool.qsize()
+    lock["write_wait_avg_ms"] = round(lock["write_wait_total_ms"] / lock["writes"], 3) if lock["writes"] else 0.0
+    lock["write_wait_total_ms"] = round(lock["write_wait_total_ms"], 3)
+    lock["write_wait_max_ms"] = round(lock["write_wait_max_ms"], 3)
+    return {"pool": pool, "lock": lock, "writer": _db_writer_metrics(), "init": _db_init_report}
+
+
 def _hash_key(value):
     """Hash determinístico para usar como clave de búsqueda (no reversible)."""
     return hashlib.sha256(value.encode("utf-8")).hexdigest()
 
 
-def _db_init():
-    """Crea la DB y tablas si no existen."""
-    with _db_lock:
-        conn = _db_conn()
+class _LRUCache:
+    """Cache LRU thread-safe, acotada por cantidad de entradas y/o bytes estimados.
+    max_items=0 o max_bytes=0 desactivan ese límite."""
+
+    def __init__(self, max_items=0, max_bytes=0):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key → (value, size)
+        self._lock = threading.Lock()
+        self._bytes = 0
+        # Se incrementa en cada invalidación: un lector que arrancó antes de una
+        # escritura no puede volver a meter el valor viejo (ver put(generation=...))
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size=1, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if self.max_bytes and size > self.max_bytes:
+                return
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._data[key] = (value, size)
+            self._bytes += size
+            while self._data and (
+                (self.max_items and len(self._data) > self.max_items)
+                or (self.max_bytes and self._bytes > self.max_bytes)
+            ):
+                _, (_, old_size) = self._data.popitem(last=False)
+                self._bytes -= old_size
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "items": len(self._data),
+                "bytes": self._bytes,
+                "max_items": self.max_items,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+class _TTLSet:
+    """Set de ids vistos con expiración fija (dedup de webhooks). Como el TTL es el
+    mismo para todos, el orden de inserción es el orden de expiración: expirar es
+    sacar del frente del OrderedDict, O(1) amortizado. Con persist=True además se
+    registra en SQLite (tabla seen_ids), así la dedup sobrevive a un restart y se
+    comparte entre procesos que usen la misma base."""
+
+    def __init__(self, scope, ttl, max_items=100000, persist=False):
+        self.scope = scope
+        self.ttl = ttl
+        self.max_items = max_items
+        self.persist = persist
+        self._data = OrderedDict()  # id → expira (epoch)
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.db_hits = 0
+
+    def _expire(self, now):
+        """Saca del frente los ids vencidos (y los que excedan max_items). Llamar con _lock."""
+        data = self._data
+        while data:
+            key, expires = next(iter(data.items()))
+            if expires > now and len(data) <= self.max_items:
+                break
+            data.popitem(last=False)
+            self.expired += 1
+
+    def add(self, key):
+        """Registra key. Retorna True si es nuevo, False si ya se vio dentro del TTL."""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if key in self._data:
+                self.hits += 1
+                return False
+            self._data[key] = now + self.ttl
+        if self.persist and not self._db_add(key, now):
+            with self._lock:
+                self.hits += 1
+                self.db_hits += 1
+            return False
+        with self._lock:
+            self.misses += 1
+        return True
+
+    def _db_add(self, key, now):
+        """INSERT atómico en seen_ids: solo gana un proceso por id (o si el anterior venció)."""
         try:
-            conn.executescript("""
-                CREATE TABLE IF NOT EXISTS tenants (
-                    phone_hash TEXT PRIMARY KEY,
-                    phone TEXT,
-                    email TEXT,
-                    plan TEXT,
-                    business_data TEXT,
-                    system_prompt TEXT,
-                    created TEXT,
-                    updated TEXT
-                );
-                CREATE TABLE IF NOT EXISTS subscribers (
-                    email_hash TEXT PRIMARY KEY,
-                    email TEXT,
-                    plan TEXT,
-                    status TEXT,
-                    mp_id TEXT,
-                    phone TEXT,
-                    updated TEXT
-                );
-                CREATE TABLE IF NOT EXISTS wa_numbers (
-                    phone_number_id TEXT PRIMARY KEY,
-                    tenant_phone_hash TEXT,
-                    access_token TEXT,
-                    business_account_id TEXT,
-                    label TEXT,
-                    status TEXT DEFAULT 'active',
-                    created TEXT,
-                    updated TEXT
-                );
-            """)
+            with _db_write() as conn:
+                cur = conn.execute(
+                    "INSERT INTO seen_ids (scope, msg_id, expires) VALUES (?, ?, ?) "
+                    "ON CONFLICT(scope, msg_id) DO UPDATE SET expires = excluded.expires "
+                    "WHERE seen_ids.expires <= ?",
+                    (self.scope, key, now + self.ttl, now),
+                )
+                conn.commit()
+                is_new = cur.rowcount > 0
+        except Exception as e:
+            # Sin la base la dedup en memoria sigue funcionando
+            print(f"[Dedup] Error registrando {self.scope}/{key}: {e}")
+            return True
+        if now - self._last_purge > self.ttl:
+            self._last_purge = now
+            _db_write_async("DELETE FROM seen_ids WHERE scope = ? AND expires <= ?", (self.scope, now),
+                            desc=f"purga seen_ids {self.scope}")
+        return is_new
+
+    def __contains__(self, key):
+        with self._lock:
+            expires = self._data.get(key)
+            return expires is not None and expires > time.time()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "items": len(self._data),
+                "ttl": self.ttl,
+                "persist": self.persist,
+                "duplicates": self.hits,
+                "duplicates_from_db": self.db_hits,
+                "new": self.misses,
+                "expired": self.expired,
+            }
+
+
+# Tenants desencriptados por phone_hash: saca Fernet + json.loads del camino de cada mensaje
+_TENANT_CACHE_MB = float(os.environ.get("LOLA_TENANT_CACHE_MB", "16"))
+_tenant_cache = _LRUCache(max_bytes=int(_TENANT_CACHE_MB * 1024 * 1024))
+
+
+def _phone_suffix_hash(phone):
+    """Hash de los últimos 8 dígitos de un teléfono, para buscar subscribers sin desencriptar.
+    Retorna "" si no hay dígitos."""
+    digits = re.sub(r"\D", "", phone or "")
+    return _hash_key(digits[-8:]) if digits else ""
+
+
+# ═══════════════ ESCRITURAS EN GRUPO (WRITE-BEHIND) ═══════════════
+# Las escrituras se encolan y un solo thread las commitea en lotes: una
+# transacción (un fsync) cada _DB_WRITE_BATCH_MS o _DB_WRITE_BATCH_ROWS filas.
+# El thread del request no espera el disco salvo que llame ticket.wait().
+
+_DB_WRITE_BATCH_MS = int(os.environ.get("LOLA_DB_BATCH_MS", "20"))
+_DB_WRITE_BATCH_ROWS = int(os.environ.get("LOLA_DB_BATCH_ROWS", "200"))
+_db_write_queue = queue.Queue()
+_db_callback_queue = queue.Queue()
+_db_writer_stats = {
+    "batches": 0, "ops": 0, "rows": 0, "failed": 0,
+    "batch_max_rows": 0, "commit_total_ms": 0.0, "commit_max_ms": 0.0,
+}
+
+
+class _DBWriteTicket:
+    """Escritura encolada + acuse de durabilidad. wait() bloquea hasta el commit y
+    retorna True/False (o None si venció el timeout)."""
+
+    def __init__(self, sql, params=(), many=False, on_commit=None, desc="", on_done=None):
+        self.sql = sql
+        self.params = params
+        self.many = many
+        self.on_commit = on_commit
+        self.on_done = on_done
+        self.desc = desc
+        self.rows = len(params) if many else 1
+        self.ok = None
+        self.rowcount = 0
+        self._event = threading.Event()
+
+    def wait(self, timeout=10):
+        if not self._event.wait(timeout):
+            return None
+        return self.ok
+
+    def _done(self, ok):
+        self.ok = ok
+        self._event.set()
+
+
+def _db_write_async(sql, params=(), many=False, on_commit=None, desc="", on_done=None):
+    """Encola una escritura para el writer en grupo. on_commit corre después del
+    commit y on_done(ok) corre siempre, haya commiteado o fallado (los dos en el
+    thread de callbacks, no en el del writer). Retorna el _DBWriteTicket."""
+    ticket = _DBWriteTicket(sql, params, many, on_commit, desc, on_done)
+    _db_write_queue.put(ticket)
+    return ticket
+
+
+def _db_write_batch(batch):
+    """Aplica un lote en una sola transacción. Cada escritura va en un SAVEPOINT:
+    si una falla se descarta solo esa, el resto del lote se commitea igual."""
+    results = []
+    t0 = time.perf_counter()
+    try:
+        with _db_write() as conn:
+            conn.execute("BEGIN")
+            for ticket in batch:
+                if ticket.sql is None:  # flush: no escribe nada
+                    results.append(True)
+                    continue
+                conn.execute("SAVEPOINT w")
+                try:
+                    if ticket.many:
+                        cur = conn.executemany(ticket.sql, ticket.params)
+                    else:
+                        cur = conn.execute(ticket.sql, ticket.params)
+                    ticket.rowcount = cur.rowcount
+                    conn.execute("RELEASE w")
+                    results.append(True)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO w")
+                    conn.execute("RELEASE w")
+                    print(f"[DB] Error en escritura ({ticket.desc}): {e}")
+                    results.append(False)
             conn.commit()
-            print(f"[DB] Inicializada: {_DB_PATH}")
-        finally:
-            conn.close()
+    except Exception as e:
+        print(f"[DB] Error commiteando lote de {len(batch)} escrituras: {e}")
+        results = [False] * len(batch)
+    ms = (time.perf_counter() - t0) * 1000
+    rows = sum(t.rows for t in batch if t.sql is not None)
+    with _db_pool_stats_lock:
+        _db_writer_stats["batches"] += 1
+        _db_writer_stats["ops"] += len(batch)
+        _db_writer_stats["rows"] += rows
+        _db_writer_stats["failed"] += results.count(False)
+        _db_writer_stats["batch_max_rows"] = max(_db_writer_stats["batch_max_rows"], rows)
+        _db_writer_stats["commit_total_ms"] += ms
+        _db_writer_stats["commit_max_ms"] = max(_db_writer_stats["commit_max_ms"], ms)
+    for ticket, ok in zip(batch, results):
+        if ticket.on_commit or ticket.on_done:
+            # Los callbacks (refresh de rutas, invalidaciones) pueden leer la DB y
+            # desencriptar: corren en su propio thread para no frenar el próximo lote
+            _db_callback_queue.put((ticket, ok))
+        else:
+            ticket._done(ok)
+
+
+def _db_callback_loop():
+    """Thread de callbacks: corre on_commit/on_done en el orden de los commits y
+    recién después marca el ticket como terminado (wait() ve sus efectos)."""
+    while True:
+        ticket, ok = _db_callback_queue.get()
+        if ok and ticket.on_commit:
+            try:
+                ticket.on_commit()
+            except Exception as e:
+                print(f"[DB] Error en on_commit ({ticket.desc}): {e}")
+        if ticket.on_done:
+            try:
+                ticket.on_done(ok)
+            except Exception as e:
+                print(f"[DB] Error en on_done ({ticket.desc}): {e}")
+        ticket._done(ok)
+
+
+def _db_writer_loop():
+    """Thread del writer: junta escrituras durante la ventana y las commitea juntas."""
+    while True:
+        ticket = _db_write_queue.get()
+        batch = [ticket]
+        rows = ticket.rows
+        deadline = time.monotonic() + _DB_WRITE_BATCH_MS / 1000
+        while rows < _DB_WRITE_BATCH_ROWS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                ticket = _db_write_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(ticket)
+            rows += ticket.rows
+        _db_write_batch(batch)
+
+
+def _db_writer_flush(timeout=10):
+    """Espera a que se commiteen todas las escrituras encoladas hasta ahora."""
+    return _db_write_async(None, desc="flush").wait(timeout)
+
+
+def _db_writer_metrics():
+    """Snapshot de métricas del writer en grupo."""
+    with _db_pool_stats_lock:
+        stats = dict(_db_writer_stats)
+    stats["queue_depth"] = _db_write_queue.qsize()
+    stats["callback_queue_depth"] = _db_callback_queue.qsize()
+    stats["avg_batch_rows"] = round(stats["rows"] / stats["batches"], 2) if stats["batches"] else 0.0
+    stats["commit_avg_ms"] = round(stats["commit_total_ms"] / stats["batches"], 3) if stats["batches"] else 0.0
+    stats["commit_total_ms"] = round(stats["commit_total_ms"], 3)
+    stats["commit_max_ms"] = round(stats["commit_max_ms"], 3)
+    return stats
+
+
+# ═══════════════ MIGRACIONES ═══════════════
+# Cada paso se aplica una sola vez, en orden, según PRAGMA user_version. Los pasos
+# son idempotentes (IF NOT EXISTS / chequeo de columnas) porque las DBs anteriores
+# a este esquema ya pueden tener parte aplicada con user_version = 0.
+
+
+def _db_add_column(conn, table, column, decl):
+    """ALTER TABLE ADD COLUMN solo si la columna no existe."""
+    cols = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in cols:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _db_m001_base_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tenants (
+            phone_hash TEXT PRIMARY KEY,
+            phone TEXT,
+            email TEXT,
+            plan TEXT,
+            business_data TEXT,
+            system_prompt TEXT,
+            created TEXT,
+            updated TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS subscribers (
+            email_hash TEXT PRIMARY KEY,
+            email TEXT,
+            plan TEXT,
+            status TEXT,
+            mp_id TEXT,
+            phone TEXT,
+            updated TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS wa_numbers (
+            phone_number_id TEXT PRIMARY KEY,
+            tenant_phone_hash TEXT,
+            access_token TEXT,
+            business_account_id TEXT,
+            label TEXT,
+            status TEXT DEFAULT 'active',
+            created TEXT,
+            updated TEXT
+        )
+    """)
+
+
+def _db_m002_subscriber_lookup_hashes(conn):
+    # Lookups de subscribers sin desencriptar: hash de los últimos 8 dígitos del
+    # teléfono y hash del mp_id, con índice
+    _db_add_column(conn, "subscribers", "phone_suffix_hash", "TEXT")
+    _db_add_column(conn, "subscribers", "mp_id_hash", "TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_subscribers_phone_suffix ON subscribers(phone_suffix_hash)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_subscribers_mp_id ON subscribers(mp_id_hash)")
+    pending = conn.execute(
+        "SELECT email_hash, phone, mp_id FROM subscribers WHERE phone_suffix_hash IS NULL OR mp_id_hash IS NULL"
+    ).fetchall()
+    for row in pending:
+        phone = _decrypt(row["phone"]) if row["phone"] else ""
+        mp_id = _decrypt(row["mp_id"]) if row["mp_id"] else ""
+        conn.execute("UPDATE subscribers SET phone_suffix_hash = ?, mp_id_hash = ? WHERE email_hash = ?",
+                     (_phone_suffix_hash(phone), _hash_key(mp_id) if mp_id else "", row["email_hash"]))
+    if pending:
+        print(f"[DB] Hashes de lookup completados para {len(pending)} subscribers")
+
+
+def _db_m003_perf_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_wa_numbers_status ON wa_numbers(status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_wa_numbers_tenant ON wa_numbers(tenant_phone_hash)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tenants_updated ON tenants(updated)")
+
+
+def _db_m004_conversations(conn):
+    # Historial de conversaciones: un registro por conversación con los turnos
+    # encriptados (JSON). conv_hash = hash del número/usuario/session_id.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            channel TEXT NOT NULL,
+            conv_hash TEXT NOT NULL,
+            messages TEXT,
+            updated REAL,
+            PRIMARY KEY (channel, conv_hash)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations(updated)")
+
+
+def _db_m005_seen_ids(conn):
+    # Dedup de webhooks compartida entre procesos/restarts (ver _TTLSet persist=True)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS seen_ids (
+            scope TEXT NOT NULL,
+            msg_id TEXT NOT NULL,
+            expires REAL NOT NULL,
+            PRIMARY KEY (scope, msg_id)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_seen_ids_expires ON seen_ids(scope, expires)")
+
+
+def _db_m006_quote_texts(conn):
+    # Textos de mensajes para resolver quote replies más allá del LRU en memoria
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS quote_texts (
+            msg_id TEXT PRIMARY KEY,
+            phone_number_id TEXT NOT NULL,
+            text TEXT,
+            ts REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_quote_texts_ts ON quote_texts(ts)")
+
+
+def _db_m007_media_cache(conn):
+    # Índice del cache de media en disco (~/.lola-media-cache/<sha256>)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS media_cache (
+            media_id TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            mime_type TEXT,
+            size INTEGER,
+            last_used REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_media_cache_sha256 ON media_cache(sha256)")
+
+
+def _db_m008_wa_numbers_media_preprocess(conn):
+    # Opt-out por número del preproceso de media (1 = achicar fotos/audios antes del LLM)
+    _db_add_column(conn, "wa_numbers", "media_preprocess", "INTEGER DEFAULT 1")
+
+
+def _db_m009_wa_numbers_history_tokens(conn):
+    # Presupuesto de tokens de historial por número (NULL/0 = LOLA_HISTORY_TOKENS)
+    _db_add_column(conn, "wa_numbers", "history_tokens", "INTEGER")
+
+
+# (versión, descripción, función). Agregar pasos nuevos al final, nunca reordenar.
+_DB_MIGRATIONS = [
+    (1, "tablas base", _db_m001_base_tables),
+    (2, "hashes de lookup en subscribers", _db_m002_subscriber_lookup_hashes),
+    (3, "índices wa_numbers(status, tenant_phone_hash) y tenants(updated)", _db_m003_perf_indexes),
+    (4, "tabla conversations", _db_m004_conversations),
+    (5, "tabla seen_ids", _db_m005_seen_ids),
+    (6, "tabla quote_texts", _db_m006_quote_texts),
+    (7, "tabla media_cache", _db_m007_media_cache),
+    (8, "columna wa_numbers.media_preprocess", _db_m008_wa_numbers_media_preprocess),
+    (9, "columna wa_numbers.history_tokens", _db_m009_wa_numbers_history_tokens),
+]
+
+# Resultado del arranque (migraciones aplicadas, pragmas, timings) para /api/admin/metrics
+_db_init_report = {}
+
+
+def _db_probe(conn):
+    """Mini workload de lectura para comparar timings con y sin el perfil de pragmas."""
+    t0 = time.perf_counter()
+    for _ in range(20):
+        conn.execute("SELECT COUNT(*) FROM tenants").fetchone()
+        conn.execute("SELECT COUNT(*) FROM wa_numbers WHERE status = 'active'").fetchone()
+        conn.execute("SELECT * FROM tenants ORDER BY updated DESC LIMIT 50").fetchall()
+    return round((time.perf_counter() - t0) * 1000, 3)
+
+
+def _db_init():
+    """Crea la DB y aplica las migraciones pendientes (PRAGMA user_version)."""
+    applied = []
+    with _db_write() as conn:
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+        for version, desc, step in _DB_MIGRATIONS:
+            if version <= current:
+                continue
+            t0 = time.perf_counter()
+            conn.execute("BEGIN")
+            try:
+                step(conn)
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                print(f"[DB] Migración {version} ({desc}) falló, se aborta el arranque")
+                raise
+            ms = round((time.perf_counter() - t0) * 1000, 3)
+            applied.append({"version": version, "description": desc, "ms": ms})
+            print(f"[DB] Migración {version} aplicada: {desc} ({ms} ms)")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    # Timings del perfil de pragmas: conexión cruda (defaults de SQLite) vs conexión del pool
+    raw = sqlite3.connect(_DB_PATH, timeout=10)
+    try:
+        before_ms = _db_probe(raw)
+    finally:
+        raw.close()
+    with _db_read() as conn:
+        after_ms = _db_probe(conn)
+
+    _db_init_report.update({
+        "schema_version": version,
+        "migrations_applied": applied,
+        "pragmas": dict(_DB_PRAGMAS),
+        "probe_ms": {"default_pragmas": before_ms, "tuned_pragmas": after_ms},
+    })
+    print(f"[DB] Inicializada: {_DB_PATH} (schema v{version}, probe {before_ms} → {after_ms} ms)")
 
 
 def _db_tenant_load(phone):
-    """Carga un tenant desde SQLite. Retorna dict o None."""
-    ph = _hash_key(phone)
-    with _db_lock:
-        conn = _db_conn()
+    """Carga un tenant desde SQLite (vía cache). Retorna dict o None."""
+    tenant = _db_tenant_load_by_hash(_hash_key(phone))
+    if tenant and not tenant["phone"]:
+        tenant["phone"] = phone
+    return tenant
+
+
+class _TenantRow:
+    """Fila de tenant con proyección de columnas y desencriptado lazy.
+    Solo trae de SQLite las columnas que se piden y desencripta cada campo la
+    primera vez que se accede. Campos: phone, email, plan, data, system_prompt,
+    created, updated (data es business_data ya parseado)."""
+
+    _COLUMNS = {
+        "phone": "phone", "email": "email", "plan": "plan", "data": "business_data",
+        "system_prompt": "system_prompt", "created": "created", "updated": "updated",
+    }
+    _ENCRYPTED = {"phone", "email", "data", "system_prompt"}
+
+    def __init__(self, phone_hash, raw=None, decoded=None):
+        self.phone_hash = phone_hash
+        self._raw = raw or {}          # campo → valor tal cual está en SQLite
+        self._decoded = decoded or {}  # campo → valor desencriptado/parseado
+
+    def _fetch(self, fields):
+        missing = [f for f in fields if f not in self._raw and f not in self._decoded]
+        if not missing:
+            return
+        cols = ", ".join(self._COLUMNS[f] for f in missing)
+        with _db_read() as conn:
+            row = conn.execute(f"SELECT {cols} FROM tenants WHERE phone_hash = ?", (self.phone_hash,)).fetchone()
+        for i, f in enumerate(missing):
+            self._raw[f] = row[i] if row else None
+
+    def has(self, field):
+        """True si el campo tiene valor, sin desencriptarlo."""
+        if field in self._decoded:
+            return bool(self._decoded[field])
+        self._fetch([field])
+        return bool(self._raw.get(field))
+
+    def get(self, field, default=None):
+        if field not in self._COLUMNS:
+            return default
+        if field not in self._decoded:
+            self._fetch([field])
+            raw = self._raw.get(field)
+            if field in self._ENCRYPTED:
+                value = _decrypt(raw) if raw else ""
+                if field == "data":
+                    value = json.loads(value) if value else {}
+            else:
+                value = raw or ""
+            self._decoded[field] = value
+        return self._decoded[field]
+
+    def __getitem__(self, field):
+        if field not in self._COLUMNS:
+            raise KeyError(field)
+        return self.get(field)
+
+
+def _db_tenant_row(phone_hash, columns=()):
+    """Retorna un _TenantRow con las columnas pedidas precargadas (sin desencriptar),
+    o None si el tenant no existe. Si el tenant completo está en _tenant_cache, no toca SQLite."""
+    cached = _tenant_cache.get(phone_hash)
+    if cached is not None:
+        return _TenantRow(phone_hash, decoded=dict(cached))
+    fields = [f for f in columns if f in _TenantRow._COLUMNS]
+    cols = ", ".join(["phone_hash"] + [_TenantRow._COLUMNS[f] for f in fields])
+    with _db_read() as conn:
         try:
-            row = conn.execute("SELECT * FROM tenants WHERE phone_hash = ?", (ph,)).fetchone()
-            if not row:
-                return None
-            return {
-                "phone": _decrypt(row["phone"]) if row["phone"] else phone,
-                "email": _decrypt(row["email"]) if row["email"] else "",
-                "plan": row["plan"] or "",
-                "data": json.loads(_decrypt(row["business_data"])) if row["business_data"] else {},
-                "system_prompt": _decrypt(row["system_prompt"]) if row["system_prompt"] else "",
-                "created": row["created"] or "",
-                "updated": row["updated"] or "",
-            }
+            row = conn.execute(f"SELECT {cols} FROM tenants WHERE phone_hash = ?", (phone_hash,)).fetchone()
         except Exception as e:
-            print(f"[DB] Error cargando tenant {phone}: {e}")
+            print(f"[DB] Error cargando tenant row {phone_hash}: {e}")
             return None
-        finally:
-            conn.close()
+    if not row:
+        return None
+    return _TenantRow(phone_hash, raw={f: row[i + 1] for i, f in enumerate(fields)})
+
+
+def _db_tenant_has_prompt(phone):
+    """True si el tenant existe y tiene system_prompt (no desencripta nada)."""
+    row = _db_tenant_row(_hash_key(phone), ("system_prompt",))
+    return row is not None and row.has("system_prompt")
 
 
 def _db_tenant_save(phone, data):
-    """Guarda un tenant en SQLite con campos sensibles encriptados."""
+    """Guarda un tenant en SQLite con campos sensibles encriptados (vía writer en grupo).
+    Retorna el _DBWriteTicket; cache y routing se refrescan recién después del commit."""
     ph = _hash_key(phone)
-    with _db_lock:
-        conn = _db_conn()
-        try:
-            business_data = data.get("data", {})
-            conn.execute("""
-                INSERT OR REPLACE INTO tenants (phone_hash, phone, email, plan, business_data, system_prompt, created, updated)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                ph,
-                _encrypt(phone),
-                _encrypt(data.get("email", "")),
-                data.get("plan", ""),
-                _encrypt(json.dumps(business_data, ensure_ascii=False)) if business_data else "",
-                _encrypt(data.get("system_prompt", "")),
-                data.get("created", time.strftime("%Y-%m-%d %H:%M")),
-                time.strftime("%Y-%m-%d %H:%M"),
-            ))
-            conn.commit()
-            print(f"[DB] Tenant guardado: {phone}")
-        except Exception as e:
-            print(f"[DB] Error guardando tenant {phone}: {e}")
-        finally:
-            conn.close()
+    business_data = data.get("data", {})
+    params = (
+        ph,
+        _encrypt(phone),
+        _encrypt(data.get("email", "")),
+        data.get("plan", ""),
+        _encrypt(json.dumps(business_data, ensure_ascii=False)) if business_data else "",
+        _encrypt(data.get("system_prompt", "")),
+        data.get("created", time.strftime("%Y-%m-%d %H:%M")),
+        time.strftime("%Y-%m-%d %H:%M"),
+    )
+
+    def _on_commit():
+        _tenant_cache.invalidate(ph)
+        print(f"[DB] Tenant guardado: {phone}")
+        _wa_routes_refresh(tenant_phone_hash=ph)
+        _answer_cache_invalidate(ph)
+        _prompt_invalidate(ph)
+
+    return _db_write_async("""
+        INSERT OR REPLACE INTO tenants (phone_hash, phone, email, plan, business_data, system_prompt, created, updated)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, params, on_commit=_on_commit, desc=f"tenant {phone}")
+
+
+_SUBSCRIBER_UPSERT_SQL = """
+    INSERT OR REPLACE INTO subscribers
+    (email_hash, email, plan, status, mp_id, phone, updated, phone_suffix_hash, mp_id_hash)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def _db_subscriber_params(email, info):
+    """Arma los parámetros de _SUBSCRIBER_UPSERT_SQL (encripta campos sensibles)."""
+    mp_id = info.get("mp_id", "")
+    return (
+        _hash_key(email),
+        _encrypt(email),
+        info.get("plan", ""),
+        info.get("status", ""),
+        _encrypt(mp_id),
+        _encrypt(info.get("phone", "")),
+        info.get("updated", ""),
+        _phone_suffix_hash(info.get("phone", "")),
+        _hash_key(mp_id) if mp_id else "",
+    )
+
+
+def _db_subscriber_from_row(row):
+    """Desencripta una fila de subscribers. Retorna (email, info)."""
+    return _decrypt(row["email"]) if row["email"] else "", {
+        "plan": row["plan"] or "",
+        "status": row["status"] or "",
+        "mp_id": _decrypt(row["mp_id"]) if row["mp_id"] else "",
+        "phone": _decrypt(row["phone"]) if row["phone"] else "",
+        "updated": row["updated"] or "",
+    }
 
 
 def _db_subscribers_load():
-    """Carga todos los subscribers desde SQLite. Retorna dict {email: info}."""
-    with _db_lock:
-        conn = _db_conn()
+    """Carga todos los subscribers desde SQLite. Retorna dict {email: info}.
+    Desencripta toda la tabla: solo para listados admin, no para lookups."""
+    with _db_read() as conn:
         try:
             rows = conn.execute("SELECT * FROM subscribers").fetchall()
             subs = {}
             for row in rows:
-                email = _decrypt(row["email"]) if row["email"] else ""
+                email, info = _db_subscriber_from_row(row)
                 if not email:
                     continue
-                subs[email] = {
-                    "plan": row["plan"] or "",
-                    "status": row["status"] or "",
-                    "mp_id": _decrypt(row["mp_id"]) if row["mp_id"] else "",
-                    "phone": _decrypt(row["phone"]) if row["phone"] else "",
-                    "updated": row["updated"] or "",
-                }
+                subs[email] = info
             return subs
         except Exception as e:
             print(f"[DB] Error cargando subscribers: {e}")
             return {}
-        finally:
-            conn.close()
 
 
 def _db_subscribers_save(subs):
-    """Guarda todos los subscribers (reemplaza la tabla completa)."""
-    with _db_lock:
-        conn = _db_conn()
+    """Inserta o actualiza un lote de subscribers (migración desde JSON). Retorna el ticket."""
+    return _db_write_async(_SUBSCRIBER_UPSERT_SQL, [
+        _db_subscriber_params(email, info) for email, info in subs.items()
+    ], many=True, desc=f"{len(subs)} subscribers")
+
+
+def _db_subscriber_upsert(email, info):
+    """Inserta o actualiza un subscriber individual (vía writer en grupo). Retorna el ticket."""
+    return _db_write_async(_SUBSCRIBER_UPSERT_SQL, _db_subscriber_params(email, info),
+                           desc=f"subscriber {email}")
+
+
+def _db_subscriber_load(email):
+    """Carga un subscriber por email (vía email_hash). Retorna info o None."""
+    with _db_read() as conn:
         try:
-            conn.execute("DELETE FROM subscribers")
-            for email, info in subs.items():
-                eh = _hash_key(email)
-                conn.execute("""
-                    INSERT INTO subscribers (email_hash, email, plan, status, mp_id, phone, updated)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    eh,
-                    _encrypt(email),
-                    info.get("plan", ""),
-                    info.get("status", ""),
-                    _encrypt(info.get("mp_id", "")),
-                    _encrypt(info.get("phone", "")),
-                    info.get("updated", ""),
-                ))
-            conn.commit()
+            row = conn.execute("SELECT * FROM subscribers WHERE email_hash = ?", (_hash_key(email),)).fetchone()
+            return _db_subscriber_from_row(row)[1] if row else None
         except Exception as e:
-            print(f"[DB] Error guardando subscribers: {e}")
-        finally:
-            conn.close()
+            print(f"[DB] Error cargando subscriber {email}: {e}")
+            return None
 
 
-def _db_subscriber_upsert(email, info):
-    """Inserta o actualiza un subscriber individual."""
-    eh = _hash_key(email)
-    with _db_lock:
-        conn = _db_conn()
+def _db_subscriber_set_status(mp_id, status):
+    """Actualiza el status de un subscriber por mp_id (vía índice en mp_id_hash).
+    Toca una sola fila y espera el commit. Retorna True si encontró el subscriber."""
+    if not mp_id:
+        return False
+    ticket = _db_write_async(
+        "UPDATE subscribers SET status = ?, updated = ? WHERE mp_id_hash = ?",
+        (status, time.strftime("%Y-%m-%d %H:%M"), _hash_key(mp_id)),
+        desc=f"subscriber status {mp_id}",
+    )
+    return bool(ticket.wait()) and ticket.rowcount > 0
+
+
+def _db_subscriber_find_by_phone(phone):
+    """Busca un subscriber por los últimos 8 dígitos del teléfono (vía índice, sin
+    desencriptar la tabla). Retorna (email, info) o None."""
+    sh = _phone_suffix_hash(phone)
+    if not sh:
+        return None
+    with _db_read() as conn:
         try:
-            conn.execute("""
-                INSERT OR REPLACE INTO subscribers (email_hash, email, plan, status, mp_id, phone, updated)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (
-                eh,
-                _encrypt(email),
-                info.get("plan", ""),
-                info.get("status", ""),
-                _encrypt(info.get("mp_id", "")),
-                _encrypt(info.get("phone", "")),
-                info.get("updated", ""),
-            ))
-            conn.commit()
+            row = conn.execute(
+                "SELECT * FROM subscribers WHERE phone_suffix_hash = ? ORDER BY rowid LIMIT 1", (sh,)
+            ).fetchone()
+            return _db_subscriber_from_row(row) if row else None
         except Exception as e:
-            print(f"[DB] Error upserting subscriber {email}: {e}")
-        finally:
-            conn.close()
+            print(f"[DB] Error buscando subscriber por teléfono: {e}")
+            return None
 
 
 def _db_wa_number_load(phone_number_id):
     """Carga un wa_number desde SQLite. Retorna dict o None."""
-    with _db_lock:
-        conn = _db_conn()
+    with _db_read() as conn:
         try:
             row = conn.execute("SELECT * FROM wa_numbers WHERE phone_number_id = ? AND status = 'active'",
                                (phone_number_id,)).fetchone()
@@ -338,45 +1051,72 @@ def _db_wa_number_load(phone_number_id):
                 "business_account_id": row["business_account_id"] or "",
                 "label": row["label"] or "",
                 "status": row["status"] or "active",
+                "media_preprocess": row["media_preprocess"] != 0,
+                "history_tokens": row["history_tokens"] or 0,
             }
         except Exception as e:
             print(f"[DB] Error cargando wa_number {phone_number_id}: {e}")
             return None
-        finally:
-            conn.close()
 
 
-def _db_wa_number_save(phone_number_id, data):
-    """Guarda un wa_number en SQLite con access_token encriptado."""
-    with _db_lock:
-        conn = _db_conn()
+def _db_wa_numbers_active(phone_number_id=None, tenant_phone_hash=None):
+    """Lista wa_numbers activos con access_token desencriptado, opcionalmente filtrados
+    por phone_number_id o tenant_phone_hash. Usado para armar la tabla de routing."""
+    sql = ("SELECT phone_number_id, tenant_phone_hash, access_token, media_preprocess, history_tokens "
+           "FROM wa_numbers WHERE status = 'active'")
+    params = ()
+    if phone_number_id is not None:
+        sql += " AND phone_number_id = ?"
+        params = (phone_number_id,)
+    elif tenant_phone_hash is not None:
+        sql += " AND tenant_phone_hash = ?"
+        params = (tenant_phone_hash,)
+    with _db_read() as conn:
         try:
-            conn.execute("""
-                INSERT OR REPLACE INTO wa_numbers
-                (phone_number_id, tenant_phone_hash, access_token, business_account_id, label, status, created, updated)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                phone_number_id,
-                data.get("tenant_phone_hash", ""),
-                _encrypt(data.get("access_token", "")),
-                data.get("business_account_id", ""),
-                data.get("label", ""),
-                data.get("status", "active"),
-                data.get("created", time.strftime("%Y-%m-%d %H:%M")),
-                time.strftime("%Y-%m-%d %H:%M"),
-            ))
-            conn.commit()
-            print(f"[DB] wa_number guardado: {phone_number_id} ({data.get('label', '')})")
+            rows = conn.execute(sql, params).fetchall()
+            return [{
+                "phone_number_id": row["phone_number_id"],
+                "tenant_phone_hash": row["tenant_phone_hash"] or "",
+                "access_token": _decrypt(row["access_token"]) if row["access_token"] else "",
+                "media_preprocess": row["media_preprocess"] != 0,
+                "history_tokens": row["history_tokens"] or 0,
+            } for row in rows]
         except Exception as e:
-            print(f"[DB] Error guardando wa_number {phone_number_id}: {e}")
-        finally:
-            conn.close()
+            print(f"[DB] Error listando wa_numbers activos: {e}")
+            return []
+
+
+def _db_wa_number_save(phone_number_id, data):
+    """Guarda un wa_number en SQLite con access_token encriptado (vía writer en grupo).
+    Retorna el _DBWriteTicket; la tabla de routing se refresca después del commit."""
+    params = (
+        phone_number_id,
+        data.get("tenant_phone_hash", ""),
+        _encrypt(data.get("access_token", "")),
+        data.get("business_account_id", ""),
+        data.get("label", ""),
+        data.get("status", "active"),
+        data.get("created", time.strftime("%Y-%m-%d %H:%M")),
+        time.strftime("%Y-%m-%d %H:%M"),
+        1 if _parse_flag(data.get("media_preprocess", True), default=True) else 0,
+        int(data.get("history_tokens") or 0) or None,
+    )
+
+    def _on_commit():
+        print(f"[DB] wa_number guardado: {phone_number_id} ({data.get('label', '')})")
+        _wa_routes_refresh(phone_number_id=phone_number_id)
+
+    return _db_write_async("""
+        INSERT OR REPLACE INTO wa_numbers
+        (phone_number_id, tenant_phone_hash, access_token, business_account_id, label, status, created, updated,
+         media_preprocess, history_tokens)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, params, on_commit=_on_commit, desc=f"wa_number {phone_number_id}")
 
 
 def _db_wa_numbers_list():
     """Lista todos los wa_numbers. Retorna lista de dicts (sin access_token desencriptado)."""
-    with _db_lock:
-        conn = _db_conn()
+    with _db_read() as conn:
         try:
             rows = conn.execute("SELECT * FROM wa_numbers ORDER BY created").fetchall()
             result = []
@@ -387,6 +1127,8 @@ def _db_wa_numbers_list():
                     "business_account_id": row["business_account_id"] or "",
                     "label": row["label"] or "",
                     "status": row["status"] or "active",
+                    "media_preprocess": row["media_preprocess"] != 0,
+                    "history_tokens": row["history_tokens"] or 0,
                     "created": row["created"] or "",
                     "updated": row["updated"] or "",
                 })
@@ -394,36 +1136,36 @@ def _db_wa_numbers_list():
         except Exception as e:
             print(f"[DB] Error listando wa_numbers: {e}")
             return []
-        finally:
-            conn.close()
 
 
 def _db_wa_numbers_count():
     """Retorna la cantidad de wa_numbers activos en la DB."""
-    with _db_lock:
-        conn = _db_conn()
+    with _db_read() as conn:
         try:
             row = conn.execute("SELECT COUNT(*) FROM wa_numbers WHERE status = 'active'").fetchone()
             return row[0] if row else 0
         except Exception:
             return 0
-        finally:
-            conn.close()
 
 
 def _db_tenant_load_by_hash(phone_hash):
-    """Carga un tenant por su phone_hash (sin saber el phone original)."""
-    with _db_lock:
-        conn = _db_conn()
+    """Carga un tenant por su phone_hash (sin saber el phone original).
+    Los tenants desencriptados quedan en _tenant_cache hasta que se vuelvan a guardar."""
+    cached = _tenant_cache.get(phone_hash)
+    if cached is not None:
+        return dict(cached)
+    gen = _tenant_cache.generation
+    with _db_read() as conn:
         try:
             row = conn.execute("SELECT * FROM tenants WHERE phone_hash = ?", (phone_hash,)).fetchone()
             if not row:
                 return None
-            return {
+            business_data = _decrypt(row["business_data"]) if row["business_data"] else ""
+            tenant = {
                 "phone": _decrypt(row["phone"]) if row["phone"] else "",
                 "email": _decrypt(row["email"]) if row["email"] else "",
                 "plan": row["plan"] or "",
-                "data": json.loads(_decrypt(row["business_data"])) if row["business_data"] else {},
+                "data": json.loads(business_data) if business_data else {},
                 "system_prompt": _decrypt(row["system_prompt"]) if row["system_prompt"] else "",
                 "created": row["created"] or "",
                 "updated": row["updated"] or "",
@@ -431,21 +1173,20 @@ def _db_tenant_load_by_hash(phone_hash):
         except Exception as e:
             print(f"[DB] Error cargando tenant by hash {phone_hash}: {e}")
             return None
-        finally:
-            conn.close()
+    # Tamaño aproximado: los strings desencriptados dominan el uso de memoria
+    size = sum(len(v) for v in tenant.values() if isinstance(v, str)) + len(business_data)
+    _tenant_cache.put(phone_hash, tenant, size=size, generation=gen)
+    return dict(tenant)
 
 
 def _db_tenants_count():
     """Retorna la cantidad de tenants en la DB."""
-    with _db_lock:
-        conn = _db_conn()
+    with _db_read() as conn:
         try:
             row = conn.execute("SELECT COUNT(*) FROM tenants").fetchone()
             return row[0] if row else 0
         except Exception:
             return 0
-        finally:
-            conn.close()
 
 
 def _db_migrate_from_json():
@@ -464,7 +1205,9 @@ def _db_migrate_from_json():
                 with open(fpath) as f:
                     data = json.load(f)
                 phone = data.get("phone", fname.replace(".json", ""))
-                _db_tenant_save(phone, data)
+                if not _db_tenant_save(phone, data).wait():
+                    print(f"[DB] Tenant {fname} no se pudo guardar, queda el JSON")
+                    continue
                 os.rename(fpath, fpath + ".bak")
                 migrated_tenants += 1
             except Exception as e:
@@ -475,9 +1218,9 @@ def _db_migrate_from_json():
         try:
             with open(subscribers_path) as f:
                 subs = json.load(f)
-            if subs:
-                _db_subscribers_save(subs)
-                migrated_subs = len(subs)
+            if subs and not _db_subscribers_save(subs).wait():
+                raise RuntimeError("no se pudieron guardar en SQLite")
+            migrated_subs = len(subs)
             os.rename(subscribers_path, subscribers_path + ".bak")
         except Exception as e:
             print(f"[DB] Error migrando subscribers: {e}")
@@ -486,9 +1229,139 @@ def _db_migrate_from_json():
         print(f"[DB] Migrados {migrated_tenants} tenants y {migrated_subs} subscribers desde JSON")
 
 
+# ═══════════════ ROUTING WHATSAPP ═══════════════
+
+# Tabla phone_number_id → wa_ctx inmutable (MappingProxyType). Nunca se muta:
+# cada refresh arma un dict nuevo y lo publica con una sola asignación.
+_wa_routes = {}
+_wa_routes_lock = threading.Lock()  # serializa los rebuilds, la lectura no lo toma
+_wa_routes_ready = False            # hasta el primer rebuild (en main) no hay nada que refrescar
+_wa_routes_unknown = _LRUCache(max_items=10000)  # negative cache: phone_number_id → ts
+_WA_ROUTES_UNKNOWN_TTL = 300  # 5 min
+_wa_routes_stats = {"hits": 0, "misses": 0, "unknown_hits": 0, "rebuilds": 0}
+# Lock propio para los contadores: _wa_routes_lock se tiene durante los rebuilds
+# (lecturas de SQLite) y el lookup no tiene que esperarlos
+_wa_routes_stats_lock = threading.Lock()
+
+
+def _wa_route_ctx(phone_number_id, access_token, tenant_phone_hash="", is_lola_sales=False, media_preprocess=True,
+                  history_tokens=0):
+    """Arma el wa_ctx inmutable de un número."""
+    if is_lola_sales:
+        system_prompt = LOLA_SALES_PROMPT
+        tenant_phone = ""
+    else:
+        # Solo se necesitan phone y system_prompt: no desencriptar email ni business_data
+        tenant = _db_tenant_row(tenant_phone_hash, ("phone", "system_prompt")) if tenant_phone_hash else None
+        system_prompt = tenant["system_prompt"] if tenant and tenant.has("system_prompt") else LOLA_SALES_PROMPT
+        tenant_phone = tenant["phone"] if tenant else ""
+    return MappingProxyType({
+        "phone_number_id": phone_number_id,
+        "access_token": access_token,
+        "system_prompt": system_prompt,
+        "tenant_phone": tenant_phone,
+        "tenant_phone_hash": tenant_phone_hash,
+        "is_lola_sales": is_lola_sales,
+        "media_preprocess": media_preprocess,
+        "history_tokens": history_tokens,
+    })
+
+
+def _wa_routes_sales_entry():
+    """Entrada del número de ventas de Lola (WA_CONFIG), o None si no está configurado."""
+    if not WA_CONFIG or not WA_CONFIG.get("phone_number_id"):
+        return None
+    return _wa_route_ctx(WA_CONFIG["phone_number_id"], WA_CONFIG.get("access_token", ""), is_lola_sales=True)
+
+
+def _wa_routes_rebuild():
+    """Arma la tabla completa desde wa_numbers + tenants. Se llama al arrancar."""
+    global _wa_routes, _wa_routes_ready
+    with _wa_routes_lock:
+        routes = {}
+        sales = _wa_routes_sales_entry()
+        if sales:
+            routes[sales["phone_number_id"]] = sales
+        # Los números de tenants tienen prioridad sobre el de ventas
+        for n in _db_wa_numbers_active():
+            routes[n["phone_number_id"]] = _wa_route_ctx(
+                n["phone_number_id"], n["access_token"], n["tenant_phone_hash"],
+                media_preprocess=n["media_preprocess"], history_tokens=n["history_tokens"])
+        _wa_routes = routes
+        _wa_routes_ready = True
+        _wa_routes_unknown.clear()
+        with _wa_routes_stats_lock:
+            _wa_routes_stats["rebuilds"] += 1
+    return len(routes)
+
+
+def _wa_routes_refresh(phone_number_id=None, tenant_phone_hash=None):
+    """Recalcula solo las entradas de un número o de un tenant y publica la tabla nueva."""
+    global _wa_routes
+    if not _wa_routes_ready:
+        return
+    with _wa_routes_lock:
+        routes = dict(_wa_routes)
+        if phone_number_id is not None:
+            stale = [phone_number_id]
+            rows = _db_wa_numbers_active(phone_number_id=phone_number_id)
+        else:
+            stale = [k for k, v in routes.items() if v["tenant_phone_hash"] == tenant_phone_hash]
+            rows = _db_wa_numbers_active(tenant_phone_hash=tenant_phone_hash)
+        for k in stale:
+            routes.pop(k, None)
+        for n in rows:
+            routes[n["phone_number_id"]] = _wa_route_ctx(
+                n["phone_number_id"], n["access_token"], n["tenant_phone_hash"],
+                media_preprocess=n["media_preprocess"], history_tokens=n["history_tokens"])
+            _wa_routes_unknown.invalidate(n["phone_number_id"])
+        # Si se desactivó un número que era el de ventas, vuelve a rutear a Lola ventas
+        sales = _wa_routes_sales_entry()
+        if sales and sales["phone_number_id"] not in routes:
+            routes[sales["phone_number_id"]] = sales
+        _wa_routes = routes
+        with _wa_routes_stats_lock:
+            _wa_routes_stats["rebuilds"] += 1
+
+
+def _wa_route(phone_number_id):
+    """Resuelve phone_number_id → wa_ctx en O(1). Retorna None si es desconocido.
+    Los desconocidos quedan en negative cache para que el tráfico basura no toque SQLite."""
+    ctx = _wa_routes.get(phone_number_id)
+    if ctx is not None:
+        with _wa_routes_stats_lock:
+            _wa_routes_stats["hits"] += 1
+        return ctx
+    seen = _wa_routes_unknown.get(phone_number_id)
+    if seen is not None and time.time() - seen < _WA_ROUTES_UNKNOWN_TTL:
+        with _wa_routes_stats_lock:
+            _wa_routes_stats["unknown_hits"] += 1
+        return None
+    # Puede haber sido dado de alta por fuera de este proceso: una sola consulta a SQLite
+    with _wa_routes_stats_lock:
+        _wa_routes_stats["misses"] += 1
+    if _db_wa_numbers_active(phone_number_id=phone_number_id):
+        _wa_routes_refresh(phone_number_id=phone_number_id)
+        return _wa_routes.get(phone_number_id)
+    _wa_routes_unknown.put(phone_number_id, time.time())
+    return None
+
+
+def _wa_routes_metrics():
+    """Snapshot de métricas de la tabla de routing."""
+    with _wa_routes_stats_lock:
+        stats = dict(_wa_routes_stats)
+    stats["routes"] = len(_wa_routes)
+    stats["unknown_cached"] = _wa_routes_unknown.stats()["items"]
+    return stats
+
+
 # Inicializar DB al arrancar
 _db_init()
-_db_migrate_from_json()
+threading.Thread(target=_db_writer_loop, name="db-writer", daemon=True).start()
+threading.Thread(target=_db_callback_loop, name="db-callbacks", daemon=True).start()
+# La migración desde JSON corre en main(): sus on_commit usan las invalidaciones de
+# cache de respuestas y prompts, definidas más abajo en el módulo
 
 # WhatsApp Business API config
 _wa_config_path = os.path.expanduser("~/.whatsapp-config.json")
@@ -549,14 +1422,26 @@ def _normalize_phone(phone):
     return digits
 
 
+def _parse_flag(value, default=None):
+    """Interpreta un flag de JSON/DB: True/1/"1"/"true" o False/0/"0"/"false".
+    Cualquier otra cosa retorna default (bool("false") sería True)."""
+    if isinstance(value, str):
+        value = value.strip().lower()
+    if value in (True, 1, "1", "true"):
+        return True
+    if value in (False, 0, "0", "false"):
+        return False
+    return default
+
+
 def _tenant_load(phone):
     """Carga datos de un tenant. Wrapper → SQLite."""
     return _db_tenant_load(phone)
 
 
 def _tenant_save(phone, data):
-    """Guarda datos de un tenant. Wrapper → SQLite."""
-    _db_tenant_save(phone, data)
+    """Guarda datos de un tenant. Wrapper → SQLite. Retorna el ticket de escritura."""
+    return _db_tenant_save(phone, data)
 
 
 def _cleanup_otp_and_sessions():
@@ -603,11 +1488,6 @@ def _mp_load_subscribers():
     return _db_subscribers_load()
 
 
-def _mp_save_subscribers(subs):
-    """Guarda suscriptores. Wrapper → SQLite."""
-    _db_subscribers_save(subs)
-
-
 def _mp_api(method, path, data=None):
     """Hace una request a la API de MercadoPago."""
     url = f"https://api.mercadopago.com{path}"
@@ -681,16 +1561,16 @@ def _mp_check_payment(phone):
 
 def _mp_check_subscription(phone):
     """Busca si hay una suscripción activa para este teléfono en los subscribers locales."""
-    subs = _mp_load_subscribers()
-    for email, info in subs.items():
-        if info.get("phone", "").endswith(phone[-8:]):  # comparar últimos 8 dígitos
-            return {
-                "found": True,
-                "plan": info.get("plan", "desconocido"),
-                "status": info.get("status", ""),
-                "email": email,
-            }
-    return {"found": False}
+    found = _db_subscriber_find_by_phone(phone)  # compara últimos 8 dígitos
+    if not found:
+        return {"found": False}
+    email, info = found
+    return {
+        "found": True,
+        "plan": info.get("plan", "desconocido"),
+        "status": info.get("status", ""),
+        "email": email,
+    }
 
 
 # Whitelist de prefijos de comandos permitidos
@@ -990,7 +1870,9 @@ def _process_onboarding_complete(session, messages):
             "created": time.strftime("%Y-%m-%d %H:%M"),
             "updated": time.strftime("%Y-%m-%d %H:%M"),
         }
-        _tenant_save(phone, tenant)
+        if not _tenant_save(phone, tenant).wait():
+            print(f"[Onboarding] No se pudo guardar el tenant {phone}")
+            return False
         session["onboarding_complete"] = True
         print(f"[Onboarding] Completado para {phone}: {data.get('nombre_negocio', '?')}")
         return True
@@ -1003,57 +1885,1053 @@ def _process_onboarding_complete(session, messages):
         return False
 
 
-def _send_whatsapp(to, text, wa_ctx=None):
-    """Envía un mensaje de texto via WhatsApp Graph API."""
+# ═══════════════ HTTP KEEP-ALIVE (GRAPH API) ═══════════════
+# Conexiones HTTP/1.1 persistentes por host: evita un handshake TCP+TLS nuevo con
+# graph.facebook.com en cada typing/send/reacción. Cada conexión la usa un solo
+# thread a la vez (checkout/checkin bajo lock).
+
+_GRAPH_BASE = os.environ.get("LOLA_GRAPH_BASE", "https://graph.facebook.com/v23.0")
+_HTTP_MAX_IDLE_PER_HOST = int(os.environ.get("LOLA_HTTP_MAX_IDLE", "8"))
+_HTTP_IDLE_MAX_SECS = float(os.environ.get("LOLA_HTTP_IDLE_SECS", "30"))  # más viejas se cierran
+_http_idle = {}  # (scheme, host, port) → [(conexión idle, monotonic del último uso)]
+_http_lock = threading.Lock()
+_http_ssl_ctx = ssl.create_default_context()
+_http_stats = {"requests": 0, "connections_opened": 0, "connections_reused": 0, "stale_retries": 0,
+               "stale_dropped": 0, "errors": 0}
+_HTTP_IDEMPOTENT = {"GET", "HEAD"}
+
+
+class _HTTPNoResponse(ConnectionError):
+    """La request (no idempotente) se mandó entera pero se cortó antes de la respuesta:
+    el server pudo haberla procesado, así que no hay que reintentarla."""
+
+
+def _http_conn_dropped(conn):
+    """True si el server ya cerró (o mandó algo en) una conexión idle: el socket está
+    legible o en EOF. Una conexión sana sin request pendiente no tiene nada para leer."""
+    sock = conn.sock
+    if sock is None:
+        return True
+    try:
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            poller.register(sock, select.POLLIN | select.POLLERR | select.POLLHUP)
+            return bool(poller.poll(0))
+        return bool(select.select([sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+
+def _http_checkout(key, timeout):
+    """Saca una conexión idle del host (o abre una nueva). Retorna (conn, reused).
+    Descarta las idle hace más de _HTTP_IDLE_MAX_SECS y las que el server ya cerró:
+    un POST sobre una de esas se perdería (no se reintenta, ver _http_open)."""
+    while True:
+        with _http_lock:
+            idle = _http_idle.get(key)
+            conn, last_used = idle.pop() if idle else (None, 0)
+        if conn is None:
+            break
+        if time.monotonic() - last_used > _HTTP_IDLE_MAX_SECS or _http_conn_dropped(conn):
+            conn.close()
+            with _http_lock:
+                _http_stats["stale_dropped"] += 1
+            continue
+        with _http_lock:
+            _http_stats["connections_reused"] += 1
+        conn.timeout = timeout
+        conn.sock.settimeout(timeout)
+        return conn, True
+    with _http_lock:
+        _http_stats["connections_opened"] += 1
+    scheme, host, port = key
+    if scheme == "https":
+        return http.client.HTTPSConnection(host, port, timeout=timeout, context=_http_ssl_ctx), False
+    return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+
+def _http_checkin(key, conn):
+    """Devuelve una conexión al pool del host (o la cierra si ya hay suficientes idle)."""
+    with _http_lock:
+        idle = _http_idle.setdefault(key, [])
+        if len(idle) < _HTTP_MAX_IDLE_PER_HOST:
+            idle.append((conn, time.monotonic()))
+            return
+    conn.close()
+
+
+@contextlib.contextmanager
+def _http_open(method, url, body=None, headers=None, timeout=30):
+    """Hace una request con conexión persistente y entrega el http.client.HTTPResponse
+    para leerlo (entero o en streaming). Al salir, si la respuesta se leyó completa
+    la conexión vuelve al pool; si no, se cierra."""
+    parsed = urlparse(url)
+    scheme = parsed.scheme or "https"
+    port = parsed.port or (443 if scheme == "https" else 80)
+    key = (scheme, parsed.hostname, port)
+    path = parsed.path or "/"
+    if parsed.query:
+        path += "?" + parsed.query
+    with _http_lock:
+        _http_stats["requests"] += 1
+    # Una conexión reusada puede haber sido cerrada por el server mientras estaba
+    # idle: en ese caso se reintenta una vez con una conexión nueva. Si el body ya
+    # se mandó entero, solo se reintentan métodos idempotentes: un POST pudo haberse
+    # procesado aunque no llegue la respuesta.
+    for attempt in (0, 1):
+        conn, reused = _http_checkout(key, timeout)
+        sent = False
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            sent = True
+            resp = conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+            conn.close()
+            if reused and attempt == 0 and (not sent or method in _HTTP_IDEMPOTENT):
+                with _http_lock:
+                    _http_stats["stale_retries"] += 1
+                continue
+            with _http_lock:
+                _http_stats["errors"] += 1
+            if sent and method not in _HTTP_IDEMPOTENT:
+                raise _HTTPNoResponse(f"{method} enviado sin respuesta: {e}") from e
+            raise
+        except Exception:
+            conn.close()
+            with _http_lock:
+                _http_stats["errors"] += 1
+            raise
+        break
+    try:
+        yield resp
+    finally:
+        if resp.isclosed() and not resp.will_close:
+            _http_checkin(key, conn)
+        else:
+            conn.close()
+
+
+def _http_request(method, url, body=None, headers=None, timeout=30):
+    """Request HTTP con keep-alive. Retorna (status, body_bytes). Lanza excepción si
+    falla la conexión; los status HTTP de error se retornan, no se lanzan."""
+    with _http_open(method, url, body=body, headers=headers, timeout=timeout) as resp:
+        return resp.status, resp.read()
+
+
+def _http_ok(status):
+    """True si el status es 2xx. http.client no sigue redirects: un 3xx no es éxito."""
+    return 200 <= status < 300
+
+
+def _graph_post(url, data, access_token, timeout=30):
+    """POST JSON a la Graph API. Retorna (status, body_bytes)."""
+    return _http_request("POST", url, body=json.dumps(data).encode("utf-8"), headers={
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {access_token}",
+    }, timeout=timeout)
+
+
+def _http_metrics():
+    """Snapshot de métricas del pool HTTP."""
+    with _http_lock:
+        stats = dict(_http_stats)
+        stats["idle"] = {f"{k[0]}://{k[1]}:{k[2]}": len(v) for k, v in _http_idle.items()}
+    return stats
+
+
+def _wa_creds(wa_ctx):
+    """(phone_number_id, access_token) del contexto de ruteo, o del número de Lola."""
     phone_number_id = (wa_ctx or {}).get("phone_number_id") or (WA_CONFIG or {}).get("phone_number_id")
     access_token = (wa_ctx or {}).get("access_token") or (WA_CONFIG or {}).get("access_token")
+    return phone_number_id, access_token
+
+
+def _send_whatsapp(to, text, wa_ctx=None):
+    """Encola un mensaje de texto para `to` y retorna enseguida (ver _wa_outbox)."""
+    phone_number_id, access_token = _wa_creds(wa_ctx)
     if not phone_number_id or not access_token:
         return
-    url = f"https://graph.facebook.com/v23.0/{phone_number_id}/messages"
-    payload = json.dumps({
-        "messaging_product": "whatsapp",
-        "to": to,
-        "type": "text",
-        "text": {"body": text},
-    }).encode("utf-8")
-    req = urllib.request.Request(url, data=payload, method="POST")
-    req.add_header("Content-Type", "application/json")
-    req.add_header("Authorization", f"Bearer {access_token}")
+    _wa_outbox.put(phone_number_id, to, _wa_send_text, to, text, wa_ctx, kind="message")
+
+
+def _wa_send_text(to, text, wa_ctx=None):
+    """Envía un mensaje de texto via WhatsApp Graph API (bloquea hasta la respuesta).
+    Retorna el status HTTP, 0 si falló antes de mandar la request o None si no hay
+    que reintentar (timeout o corte sin respuesta: el mensaje pudo haber llegado).
+    Ver _SendGovernor.settle()."""
+    phone_number_id, access_token = _wa_creds(wa_ctx)
+    if not phone_number_id or not access_token:
+        return None
+    url = f"{_GRAPH_BASE}/{phone_number_id}/messages"
     try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            resp_body = json.loads(resp.read())
-            sent_id = resp_body.get("messages", [{}])[0].get("id", "")
-            if sent_id:
-                _wa_msg_texts[sent_id] = text[:500]
-                # Limpiar si hay demasiados
-                if len(_wa_msg_texts) > _WA_MSG_TEXTS_MAX:
-                    keys = list(_wa_msg_texts.keys())
-                    for k in keys[:len(keys) // 2]:
-                        del _wa_msg_texts[k]
-            print(f"[WhatsApp] Mensaje enviado a {to}: {resp.status}")
-    except urllib.error.HTTPError as e:
-        body = e.read().decode("utf-8", errors="replace")
-        print(f"[WhatsApp] Error enviando a {to}: {e.code} {body}")
+        status, body = _graph_post(url, {
+            "messaging_product": "whatsapp",
+            "to": to,
+            "type": "text",
+            "text": {"body": text},
+        }, access_token, timeout=30)
+    except (TimeoutError, _HTTPNoResponse) as e:
+        print(f"[WhatsApp] Sin respuesta enviando a {to}: {e}")
+        return None
     except Exception as e:
         print(f"[WhatsApp] Error enviando a {to}: {e}")
+        return 0
+    if not _http_ok(status):
+        print(f"[WhatsApp] Error enviando a {to}: {status} {body.decode('utf-8', errors='replace')}")
+        return status
+    # Graph ya aceptó el mensaje: un error de acá en adelante no debe reintentar el envío
+    try:
+        sent_id = (json.loads(body).get("messages") or [{}])[0].get("id", "")
+        if sent_id:
+            _wa_quote_put(phone_number_id, sent_id, text)
+    except Exception as e:
+        print(f"[WhatsApp] Error registrando el envío a {to}: {e}")
+    print(f"[WhatsApp] Mensaje enviado a {to}: {status}")
+    return status
 
 
-# Historial de conversaciones por número de WhatsApp
+# ═══════════════ POOL DE WORKERS ═══════════════
+
+
+class _WorkerPool:
+    """Pool fijo de threads con cola acotada. submit() no bloquea: si la cola está
+    llena retorna False y el que llama decide (reintentar más tarde, descartar)."""
+
+    def __init__(self, name, workers, queue_max):
+        self.name = name
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=queue_max)
+        self._lock = threading.Lock()
+        self._stats = {
+            "submitted": 0, "rejected": 0, "completed": 0, "failed": 0, "busy": 0,
+            "queue_max_seen": 0, "wait_total_ms": 0.0, "wait_max_ms": 0.0, "run_total_ms": 0.0,
+        }
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True).start()
+
+    def submit(self, fn, *args, **kwargs):
+        try:
+            self._queue.put_nowait((time.perf_counter(), fn, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                self._stats["rejected"] += 1
+            return False
+        with self._lock:
+            self._stats["submitted"] += 1
+            self._stats["queue_max_seen"] = max(self._stats["queue_max_seen"], self._queue.qsize())
+        return True
+
+    def _run(self):
+        while True:
+            enqueued, fn, args, kwargs = self._queue.get()
+            started = time.perf_counter()
+            wait_ms = (started - enqueued) * 1000
+            with self._lock:
+                self._stats["busy"] += 1
+                self._stats["wait_total_ms"] += wait_ms
+                self._stats["wait_max_ms"] = max(self._stats["wait_max_ms"], wait_ms)
+            ok = True
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                ok = False
+                print(f"[{self.name}] Excepción en worker: {e}")
+            with self._lock:
+                self._stats["busy"] -= 1
+                self._stats["completed" if ok else "failed"] += 1
+                self._stats["run_total_ms"] += (time.perf_counter() - started) * 1000
+
+    def stats(self):
+        with self._lock:
+            st = dict(self._stats)
+        done = st["completed"] + st["failed"]
+        started = done + st["busy"]
+        st["workers"] = self.workers
+        st["queue_depth"] = self._queue.qsize()
+        st["queue_limit"] = self._queue.maxsize
+        st["wait_avg_ms"] = round(st["wait_total_ms"] / started, 3) if started else 0.0
+        st["run_avg_ms"] = round(st["run_total_ms"] / done, 3) if done else 0.0
+        for k in ("wait_total_ms", "wait_max_ms", "run_total_ms"):
+            st[k] = round(st[k], 3)
+        return st
+
+
+class _ScheduledCall:
+    """Handle de una llamada agendada en _Scheduler."""
+    __slots__ = ("when", "seq", "fn", "args", "key", "cancelled")
+
+    def __init__(self, when, seq, fn, args, key):
+        self.when = when
+        self.seq = seq
+        self.fn = fn
+        self.args = args
+        self.key = key
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+
+class _Scheduler:
+    """Un solo thread con un heap de deadlines, en vez de un threading.Timer
+    (un thread durmiendo) por cada acción demorada. Las funciones corren en el
+    thread del scheduler, así que tienen que ser rápidas: lo normal es que solo
+    hagan submit a un pool. Las llamadas con key se pueden cancelar o
+    reagendar por key (una sola pendiente por key)."""
+
+    def __init__(self, name):
+        self.name = name
+        self._heap = []
+        self._by_key = {}
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._stats = {"scheduled": 0, "fired": 0, "cancelled": 0, "failed": 0, "lag_max_ms": 0.0}
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    def call_later(self, delay, fn, *args, key=None):
+        """Agenda fn(*args) en delay segundos. Si ya había una llamada con la misma
+        key, la reemplaza. Retorna el handle."""
+        with self._cond:
+            if key is not None:
+                old = self._by_key.pop(key, None)
+                if old is not None:
+                    old.cancelled = True
+                    self._stats["cancelled"] += 1
+            self._seq += 1
+            call = _ScheduledCall(time.monotonic() + delay, self._seq, fn, args, key)
+            heapq.heappush(self._heap, call)
+            if key is not None:
+                self._by_key[key] = call
+            self._stats["scheduled"] += 1
+            self._cond.notify()
+        return call
+
+    def cancel(self, call):
+        """Cancela una llamada pendiente (por handle). Retorna True si estaba pendiente."""
+        with self._cond:
+            if call.cancelled:
+                return False
+            call.cancelled = True
+            if call.key is not None and self._by_key.get(call.key) is call:
+                del self._by_key[call.key]
+            self._stats["cancelled"] += 1
+            return True
+
+    def cancel_key(self, key):
+        """Cancela la llamada pendiente con esa key, si hay."""
+        with self._cond:
+            call = self._by_key.get(key)
+        return self.cancel(call) if call else False
+
+    def reschedule(self, key, delay):
+        """Mueve el deadline de la llamada pendiente con esa key. Retorna False si no hay."""
+        with self._cond:
+            call = self._by_key.get(key)
+            if call is None:
+                return False
+        self.call_later(delay, call.fn, *call.args, key=key)
+        return True
+
+    def pending(self, key):
+        with self._cond:
+            return key in self._by_key
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    # Descartar cancelados del tope del heap (borrado lazy)
+                    while self._heap and self._heap[0].cancelled:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait = self._heap[0].when - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                call = heapq.heappop(self._heap)
+                if call.key is not None and self._by_key.get(call.key) is call:
+                    del self._by_key[call.key]
+                lag_ms = (time.monotonic() - call.when) * 1000
+                self._stats["fired"] += 1
+                self._stats["lag_max_ms"] = max(self._stats["lag_max_ms"], lag_ms)
+            try:
+                call.fn(*call.args)
+            except Exception as e:
+                with self._cond:
+                    self._stats["failed"] += 1
+                print(f"[{self.name}] Excepción en llamada agendada: {e}")
+
+    def stats(self):
+        with self._cond:
+            st = dict(self._stats)
+            st["pending"] = sum(1 for c in self._heap if not c.cancelled)
+        st["lag_max_ms"] = round(st["lag_max_ms"], 3)
+        return st
+
+
+# Scheduler único para debounce, pausas y pacing de respuestas
+_scheduler = _Scheduler("scheduler")
+
+# Procesamiento de mensajes de WhatsApp (LLM + respuesta). Tamaño configurable
+# para dimensionarlo según la Pi: cada worker bloquea mientras espera al LLM.
+_wa_pool = _WorkerPool(
+    "WhatsApp-worker",
+    int(os.environ.get("LOLA_WA_WORKERS", "8")),
+    int(os.environ.get("LOLA_WA_QUEUE_MAX", "200")),
+)
+
+
+# ═══════════════ ENVÍOS SALIENTES ═══════════════
+# Cada destinatario tiene su fila (lane) de llamadas a la Graph API: dentro de una
+# lane se ejecutan de a una y en orden (typing → chunk 1 → chunk 2...), mientras que
+# lanes distintas corren en paralelo en _wa_send_pool. Por phone_number_id hay un
+# tope de requests en vuelo; las lanes que no entran esperan su turno en ronda.
+# _SendGovernor limita el ritmo por número (token bucket) y reintenta 429/5xx con
+# backoff: una ráfaga se encola en vez de perder mensajes.
+
+_WA_RETRYABLE = frozenset((0, 429, 500, 502, 503, 504))  # 0 = falló la conexión
+# Typing y reacciones no se reintentan: detrás esperan los chunks de la respuesta en
+# la misma lane, y un "escribiendo..." reintentado segundos después ya no sirve
+_WA_NO_RETRY_KINDS = frozenset(("typing", "reaction"))
+_DAY_SECS = 24 * 3600
+
+
+class _SendGovernor:
+    """Token bucket por phone_number_id, backoff exponencial con jitter para
+    errores transitorios y conteo de uso diario (ventana móvil de 24h)."""
+
+    def __init__(self, rate, burst, daily_limit, max_retries, backoff_base=1.0, backoff_max=60.0):
+        self.rate = rate
+        self.burst = burst
+        self.daily_limit = daily_limit
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._buckets = {}  # pnid → [tokens, última recarga, bloqueado_hasta]
+        self._usage = {}    # pnid → {"sent": deque de ts, "recipients": OrderedDict to → ts, ...}
+
+    def acquire(self, pnid):
+        """Toma un token del número. Retorna 0 si se puede enviar ya, o los segundos a esperar."""
+        now = time.monotonic()
+        with self._lock:
+            b = self._buckets.get(pnid)
+            if b is None:
+                b = self._buckets[pnid] = [float(self.burst), now, 0.0]
+            if now < b[2]:
+                self._number(pnid)["throttled"] += 1
+                return b[2] - now
+            b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+            b[1] = now
+            if b[0] >= 1:
+                b[0] -= 1
+                return 0
+            self._number(pnid)["throttled"] += 1
+            return (1 - b[0]) / self.rate
+
+    def settle(self, pnid, to, kind, status, attempt):
+        """Registra el resultado de un envío. Retorna los segundos hasta el reintento,
+        o None si el job terminó (ok, error definitivo o reintentos agotados)."""
+        if status is None:
+            return None
+        with self._lock:
+            u = self._number(pnid)
+            if _http_ok(status):
+                u["ok"] += 1
+                if kind == "message":
+                    self._record_message(pnid, u, to)
+                return None
+            u["errors"][str(status)] = u["errors"].get(str(status), 0) + 1
+            if status not in _WA_RETRYABLE or kind in _WA_NO_RETRY_KINDS:
+                return None
+            if attempt >= self.max_retries:
+                u["dropped"] += 1
+                print(f"[Governor] {pnid}: {kind} a {to} descartado tras {attempt + 1} intentos (último {status})")
+                return None
+            # Full jitter: entre la mitad y el total del backoff exponencial
+            delay = min(self.backoff_max, self.backoff_base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+            if status == 429:
+                # Meta limitó el número entero: frenar todas sus lanes, no solo esta
+                b = self._buckets.get(pnid)
+                if b is not None:
+                    b[2] = max(b[2], time.monotonic() + delay)
+            u["retried"] += 1
+            return delay
+
+    def _number(self, pnid):
+        """Contadores de un número. Llamar con _lock."""
+        u = self._usage.get(pnid)
+        if u is None:
+            u = self._usage[pnid] = {
+                "sent": deque(), "recipients": OrderedDict(), "warned": 0,
+                "ok": 0, "throttled": 0, "retried": 0, "dropped": 0, "errors": {},
+            }
+        return u
+
+    def _record_message(self, pnid, u, to):
+        """Suma un mensaje al uso diario y avisa al cruzar 80% y 100% del límite. Llamar con _lock."""
+        now = time.time()
+        u["sent"].append(now)
+        u["recipients"][to] = now
+        u["recipients"].move_to_end(to)
+        self._prune(u, now)
+        if not self.daily_limit:
+            return
+        used = len(u["recipients"])
+        for level in (100, 80):
+            if used * 100 >= self.daily_limit * level:
+                if u["warned"] < level:
+                    u["warned"] = level
+                    print(f"[Governor] {pnid}: {used}/{self.daily_limit} destinatarios en 24h ({level}% del tier diario)")
+                break
+        else:
+            u["warned"] = 0
+
+    @staticmethod
+    def _prune(u, now):
+        cutoff = now - _DAY_SECS
+        while u["sent"] and u["sent"][0] < cutoff:
+            u["sent"].popleft()
+        recipients = u["recipients"]
+        while recipients:
+            to, ts = next(iter(recipients.items()))
+            if ts >= cutoff:
+                break
+            recipients.popitem(last=False)
+
+    def stats(self):
+        now = time.time()
+        out = {}
+        with self._lock:
+            for pnid, u in self._usage.items():
+                self._prune(u, now)
+                b = self._buckets.get(pnid)
+                out[pnid] = {
+                    "messages_24h": len(u["sent"]),
+                    "recipients_24h": len(u["recipients"]),
+                    "daily_limit": self.daily_limit,
+                    "daily_usage_pct": round(len(u["recipients"]) * 100 / self.daily_limit, 1) if self.daily_limit else None,
+                    "tokens": round(b[0], 1) if b else None,
+                    "ok": u["ok"], "throttled": u["throttled"], "retried": u["retried"],
+                    "dropped": u["dropped"], "errors": dict(u["errors"]),
+                }
+        return {"rate_per_sec": self.rate, "burst": self.burst, "max_retries": self.max_retries, "numbers": out}
+
+
+class _Outbox:
+    """Filas ordenadas por (phone_number_id, destinatario) con tope de concurrencia
+    por phone_number_id. put() no bloquea. Si hay governor, cada job espera su token
+    y los errores transitorios se reintentan sin perder el orden de la lane."""
+
+    def __init__(self, name, pool, max_inflight, governor=None):
+        self.name = name
+        self.max_inflight = max_inflight
+        self._pool = pool
+        self._governor = governor
+        self._lock = threading.Lock()
+        self._lanes = {}     # (pnid, to) → deque de [fn, args, kind, encolado_en, intento]
+        self._active = set()  # lanes con un job en vuelo o esperando cupo
+        self._waiting = {}   # pnid → deque de lanes esperando cupo
+        self._inflight = {}  # pnid → requests en vuelo
+        self._stats = {
+            "enqueued": 0, "completed": 0, "failed": 0, "waited_slot": 0,
+            "wait_total_ms": 0.0, "wait_max_ms": 0.0, "lane_max_depth": 0,
+        }
+
+    def put(self, pnid, to, fn, *args, kind="call"):
+        lane = (pnid, to)
+        with self._lock:
+            q = self._lanes.get(lane)
+            if q is None:
+                q = self._lanes[lane] = deque()
+            q.append([fn, args, kind, time.monotonic(), 0])
+            self._stats["enqueued"] += 1
+            if len(q) > self._stats["lane_max_depth"]:
+                self._stats["lane_max_depth"] = len(q)
+            if lane in self._active:
+                return  # el job en vuelo de la lane va a tomar este al terminar
+            self._active.add(lane)
+            ready = self._claim(lane)
+        if ready:
+            self._dispatch(lane)
+
+    def _claim(self, lane):
+        """Toma un cupo del pnid para la lane, o la deja esperando. Llamar con _lock."""
+        pnid = lane[0]
+        if self._inflight.get(pnid, 0) < self.max_inflight and not self._waiting.get(pnid):
+            self._inflight[pnid] = self._inflight.get(pnid, 0) + 1
+            return True
+        self._waiting.setdefault(pnid, deque()).append(lane)
+        self._stats["waited_slot"] += 1
+        return False
+
+    def _dispatch(self, lane):
+        if not self._pool.submit(self._run, lane):
+            _scheduler.call_later(0.2, self._dispatch, lane)
+
+    def _run(self, lane):
+        pnid, to = lane
+        with self._lock:
+            job = self._lanes[lane][0]
+        fn, args, kind, enqueued_at, attempt = job
+        if self._governor is not None:
+            wait = self._governor.acquire(pnid)
+            if wait > 0:
+                # Sin token: la lane conserva su cupo y el job sigue primero en la fila
+                _scheduler.call_later(wait, self._dispatch, lane)
+                return
+        wait_ms = (time.monotonic() - enqueued_at) * 1000
+        ok = True
+        result = None
+        try:
+            result = fn(*args)
+        except Exception as e:
+            ok = False
+            print(f"[{self.name}] Error en {getattr(fn, '__name__', fn)}: {e}")
+        if ok and self._governor is not None:
+            retry_in = self._governor.settle(pnid, to, kind, result, attempt)
+            if retry_in is not None:
+                job[4] = attempt + 1
+                _scheduler.call_later(retry_in, self._dispatch, lane)
+                return
+        ready = []
+        with self._lock:
+            self._lanes[lane].popleft()
+            self._stats["completed" if ok else "failed"] += 1
+            self._stats["wait_total_ms"] += wait_ms
+            if wait_ms > self._stats["wait_max_ms"]:
+                self._stats["wait_max_ms"] = wait_ms
+            self._inflight[pnid] -= 1
+            waiting = self._waiting.setdefault(pnid, deque())
+            if self._lanes[lane]:
+                waiting.append(lane)  # al final de la ronda: no acapara el cupo
+            else:
+                del self._lanes[lane]
+                self._active.discard(lane)
+            while waiting and self._inflight[pnid] < self.max_inflight:
+                ready.append(waiting.popleft())
+                self._inflight[pnid] += 1
+            if not waiting:
+                del self._waiting[pnid]
+            if not self._inflight[pnid]:
+                del self._inflight[pnid]
+        for next_lane in ready:
+            self._dispatch(next_lane)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["lanes"] = len(self._lanes)
+            stats["pending"] = sum(len(q) for q in self._lanes.values())
+            stats["inflight"] = dict(self._inflight)
+            stats["waiting_lanes"] = {pnid: len(w) for pnid, w in self._waiting.items()}
+        stats["max_inflight"] = self.max_inflight
+        stats["wait_total_ms"] = round(stats["wait_total_ms"], 1)
+        stats["wait_max_ms"] = round(stats["wait_max_ms"], 1)
+        return stats
+
+
+_wa_send_pool = _WorkerPool(
+    "WhatsApp-sender",
+    int(os.environ.get("LOLA_WA_SENDERS", "16")),
+    int(os.environ.get("LOLA_WA_SEND_QUEUE_MAX", "1000")),
+)
+_wa_governor = _SendGovernor(
+    rate=float(os.environ.get("LOLA_WA_RATE_PER_SEC", "20")),
+    burst=int(os.environ.get("LOLA_WA_RATE_BURST", "20")),
+    daily_limit=int(os.environ.get("LOLA_WA_DAILY_LIMIT", "250")),
+    max_retries=int(os.environ.get("LOLA_WA_SEND_RETRIES", "5")),
+)
+_wa_outbox = _Outbox(
+    "WhatsApp-outbox", _wa_send_pool, int(os.environ.get("LOLA_WA_MAX_INFLIGHT", "4")), governor=_wa_governor,
+)
+
+
+# ═══════════════ HISTORIAL DE CONVERSACIONES ═══════════════
+# Los turnos se persisten encriptados en SQLite (vía writer en grupo) y en memoria
+# solo quedan las conversaciones activas, en un LRU acotado. Si un usuario vuelve
+# después de un restart o de salir del LRU, su historial se rehidrata de SQLite.
 # Cada entrada: {"messages": [{"role": "user"|"model", "text": str}, ...], "ts": timestamp}
-_wa_history = {}
-_WA_HISTORY_MAX = 20       # máximo de turnos (user+model) por conversación
+
+_CONV_HOT_MAX = int(os.environ.get("LOLA_CONV_HOT_MAX", "500"))
+_CONV_HOT_MB = float(os.environ.get("LOLA_CONV_HOT_MB", "16"))
+_CONV_RETENTION_SECS = 24 * 3600  # filas más viejas se borran al arrancar y cada hora
+_CONV_PURGE_EVERY_SECS = 3600
+_conv_hot = _LRUCache(max_items=_CONV_HOT_MAX, max_bytes=int(_CONV_HOT_MB * 1024 * 1024))
+_conv_lock = threading.Lock()
+_conv_stats = {"rehydrated": 0, "persisted": 0, "expired": 0}
+_conv_pending = {}  # (channel, key) → (entry, seq) de la última escritura sin commitear
+_conv_seq = 0
+
+
+def _conv_size(entry):
+    """Tamaño aproximado de una conversación en memoria (texto de los turnos)."""
+    return sum(len(m["text"]) for m in entry["messages"]) + 64
+
+
+def _conv_cached(ck, ttl):
+    """Entrada en memoria (o fijada con escritura pendiente), o None si hay que ir a
+    SQLite. Si expiró por inactividad la reemplaza por una vacía. Llamar con _conv_lock."""
+    now = time.time()
+    entry = _conv_hot.get(ck)
+    if entry is None and ck in _conv_pending:
+        # Salió del LRU con una escritura todavía en cola: SQLite tiene una versión
+        # vieja, la vigente es la que espera al writer
+        entry = _conv_pending[ck][0]
+        _conv_hot.put(ck, entry, size=_conv_size(entry))
+    if entry is not None and now - entry["ts"] > ttl:
+        # Expiró por inactividad: se arranca de cero (y se vacía la copia persistida)
+        entry = {"messages": [], "ts": now}
+        _conv_hot.put(ck, entry, size=_conv_size(entry))
+        _conv_write(ck, None, now, f"conversación {ck[0]} expirada", _conv_pin(ck, entry))
+        _conv_stats["expired"] += 1
+    return entry
+
+
+def _conv_read(channel, key, ttl):
+    """Lee y desencripta una conversación de SQLite (sin _conv_lock).
+    Retorna (entry, rehidratada)."""
+    now = time.time()
+    with _db_read() as conn:
+        row = conn.execute(
+            "SELECT messages, updated FROM conversations WHERE channel = ? AND conv_hash = ?",
+            (channel, _hash_key(key)),
+        ).fetchone()
+    if row and row["messages"] and now - row["updated"] <= ttl:
+        try:
+            messages = json.loads(_decrypt(row["messages"]))
+            # Turnos guardados antes de la ventana por tokens: se completa la
+            # estimación acá, antes de que la entrada sea visible para otros threads
+            for m in messages:
+                if "tokens" not in m:
+                    m["tokens"] = _turn_tokens_estimate(m["text"])
+            return {"messages": messages, "ts": row["updated"]}, True
+        except Exception as e:
+            print(f"[Historial] Error rehidratando {channel}: {e}")
+    return {"messages": [], "ts": now}, False
+
+
+@contextlib.contextmanager
+def _conv_entry(channel, key, ttl):
+    """with _conv_entry(...) as entry: la conversación con _conv_lock tomado. Si no está
+    en memoria, la lectura de SQLite y el descifrado se hacen antes de tomar el lock,
+    para que una rehidratación no frene a las demás conversaciones."""
+    ck = (channel, key)
+    with _conv_lock:
+        entry = _conv_cached(ck, ttl)
+        if entry is not None:
+            yield entry
+            return
+    loaded, rehydrated = _conv_read(channel, key, ttl)
+    with _conv_lock:
+        # Otro thread pudo cargarla o escribirla mientras se leía
+        entry = _conv_cached(ck, ttl)
+        if entry is None:
+            entry = loaded
+            _conv_hot.put(ck, entry, size=_conv_size(entry))
+            if rehydrated:
+                _conv_stats["rehydrated"] += 1
+        yield entry
+
+
+def _conv_pin(ck, entry):
+    """Fija entry en _conv_pending hasta que el writer termine la escritura que se va a
+    encolar. Llamar con _conv_lock; retorna el on_done para esa escritura."""
+    global _conv_seq
+    _conv_seq += 1
+    seq = _conv_seq
+    _conv_pending[ck] = (entry, seq)
+
+    def _unpin(ok):
+        with _conv_lock:
+            pinned = _conv_pending.get(ck)
+            if pinned and pinned[1] == seq:
+                del _conv_pending[ck]
+    return _unpin
+
+
+def _conv_write(ck, blob, ts, desc, on_done):
+    """Encola la fila de una conversación (blob None = vacía). El UPSERT solo pisa filas
+    más viejas: si dos escrituras de la misma conversación llegan al writer en otro
+    orden, queda la más nueva."""
+    channel, key = ck
+    return _db_write_async(
+        "INSERT INTO conversations (channel, conv_hash, messages, updated) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(channel, conv_hash) DO UPDATE SET messages = excluded.messages, updated = excluded.updated "
+        "WHERE excluded.updated >= conversations.updated",
+        (channel, _hash_key(key), blob, ts),
+        desc=desc, on_done=on_done,
+    )
+
+
+def _conv_get(channel, key, ttl):
+    """Devuelve una copia del historial de una conversación ([] si no hay o expiró)."""
+    with _conv_entry(channel, key, ttl) as entry:
+        return list(entry["messages"])
+
+
+def _conv_append(channel, key, role, text, ttl, max_msgs):
+    """Agrega un turno, recorta a max_msgs (sacando los más viejos) y persiste async.
+    Cada turno guarda su estimación de tokens (ver _history_window)."""
+    ck = (channel, key)
+    with _conv_entry(channel, key, ttl) as entry:
+        entry["ts"] = time.time()
+        entry["messages"].append({"role": role, "text": text, "tokens": _turn_tokens_estimate(text)})
+        while len(entry["messages"]) > max_msgs:
+            entry["messages"].pop(0)
+        # Re-put para actualizar el tamaño contabilizado en el LRU
+        _conv_hot.put(ck, entry, size=_conv_size(entry))
+        blob = json.dumps(entry["messages"], ensure_ascii=False)
+        ts = entry["ts"]
+        on_done = _conv_pin(ck, entry)
+        _conv_stats["persisted"] += 1
+    _conv_write(ck, _encrypt(blob), ts, f"conversación {channel}", on_done)
+
+
+def _conv_reset(channel, key):
+    """Vacía el historial de una conversación (memoria y SQLite). La entrada vacía queda
+    en memoria, así un _conv_get inmediato no rehidrata la fila vieja antes del commit."""
+    ck = (channel, key)
+    with _conv_lock:
+        entry = {"messages": [], "ts": time.time()}
+        _conv_hot.put(ck, entry, size=_conv_size(entry))
+        _conv_write(ck, None, entry["ts"], f"reset conversación {channel}", _conv_pin(ck, entry))
+
+
+def _conv_purge_expired():
+    """Borra de SQLite las conversaciones sin actividad hace más de _CONV_RETENTION_SECS
+    y se vuelve a agendar, para que un server que no se reinicia no acumule filas."""
+    _scheduler.call_later(_CONV_PURGE_EVERY_SECS, _conv_purge_expired, key="conv-purge")
+    return _db_write_async("DELETE FROM conversations WHERE updated < ?",
+                           (time.time() - _CONV_RETENTION_SECS,), desc="purga de conversaciones")
+
+
+def _conv_metrics():
+    """Snapshot de métricas del historial (hot set + rehidrataciones)."""
+    with _conv_lock:
+        stats = dict(_conv_stats)
+        stats["pending"] = len(_conv_pending)
+    stats["hot"] = _conv_hot.stats()
+    return stats
+
+
+# Ventana de historial por presupuesto de tokens: se guardan hasta *_HISTORY_MAX
+# turnos, pero al LLM se manda la cola más larga que entra en el presupuesto
+# (LOLA_HISTORY_TOKENS, o wa_numbers.history_tokens por número). Un CSV pegado o
+# una respuesta larga ocupan lo que pesan; un chat de mensajes cortos manda más turnos.
+_HISTORY_TOKENS = int(os.environ.get("LOLA_HISTORY_TOKENS", "4000"))
+_HISTORY_TOKENS_MAX = 100000  # tope para wa_numbers.history_tokens
+_TURN_OVERHEAD_TOKENS = 4  # rol + separadores de cada turno
+_history_stats = {
+    "windows": 0, "turns_sent": 0, "turns_dropped": 0,
+    "contexts": 0, "context_tokens_total": 0, "context_tokens_max": 0,
+}
+_history_stats_lock = threading.Lock()
+
+
+def _turn_tokens_estimate(text):
+    return _estimate_tokens(text) + _TURN_OVERHEAD_TOKENS
+
+
+def _turn_tokens(turn):
+    """Tokens de un turno guardado. No escribe en el turno: los dicts son compartidos
+    con el hot set (los turnos viejos se completan al rehidratar, ver _conv_read)."""
+    tokens = turn.get("tokens")
+    return _turn_tokens_estimate(turn["text"]) if tokens is None else tokens
+
+
+def _history_window(history, budget, reserved=0):
+    """Los turnos más recientes de history que entran en budget - reserved tokens.
+    Retorna (turnos listos para el LLM, tokens del historial enviado)."""
+    available = budget - reserved
+    used = 0
+    start = len(history)
+    while start > 0:
+        tokens = _turn_tokens(history[start - 1])
+        if used + tokens > available:
+            break
+        used += tokens
+        start -= 1
+    window = [{"role": m["role"], "text": m["text"]} for m in history[start:]]
+    if not window and history and available > _TURN_OVERHEAD_TOKENS:
+        # El último turno solo ya no entra (un CSV, una respuesta larga): se manda
+        # recortado para no perder el contexto inmediato de la conversación
+        last = history[-1]
+        # -1 por el "…": el turno recortado tiene que entrar en available
+        keep = (available - _TURN_OVERHEAD_TOKENS) * 4 - 1
+        window = [{"role": last["role"], "text": last["text"][:keep] + "…"}]
+        used = _turn_tokens_estimate(window[0]["text"])
+        start -= 1
+    with _history_stats_lock:
+        _history_stats["windows"] += 1
+        _history_stats["turns_sent"] += len(history) - start
+        _history_stats["turns_dropped"] += start
+    return window, used
+
+
+def _history_record_context(tokens):
+    """Registra el tamaño de contexto (prompt + historial + mensaje) de una llamada al LLM."""
+    with _history_stats_lock:
+        _history_stats["contexts"] += 1
+        _history_stats["context_tokens_total"] += tokens
+        if tokens > _history_stats["context_tokens_max"]:
+            _history_stats["context_tokens_max"] = tokens
+
+
+def _history_metrics():
+    with _history_stats_lock:
+        stats = dict(_history_stats)
+    stats["budget_default"] = _HISTORY_TOKENS
+    # Promedio sobre llamadas al LLM, no sobre ventanas (un hit del cache arma ventana pero no llama)
+    stats["context_tokens_avg"] = round(stats["context_tokens_total"] / stats["contexts"]) if stats["contexts"] else 0
+    return stats
+
+
+# Historial de conversaciones por número de WhatsApp
+_WA_HISTORY_MAX = 60       # turnos guardados (user+model); lo enviado lo acota _history_window
 _WA_HISTORY_TTL = 30 * 60  # 30 minutos sin actividad → se borra el historial
 
 # Deduplicación de mensajes de WhatsApp (Meta reenvía si tarda)
-_wa_seen_ids = {}
+# LOLA_DEDUP_PERSIST=1 la comparte via SQLite entre procesos y restarts
+_DEDUP_PERSIST = os.environ.get("LOLA_DEDUP_PERSIST", "0") == "1"
 _WA_SEEN_TTL = 120  # 2 minutos
+_wa_seen_ids = _TTLSet("wa", _WA_SEEN_TTL, persist=_DEDUP_PERSIST)
+
+# Índice msg_id → texto para resolver quote replies. Un LRU por phone_number_id
+# (un tenant con mucho tráfico no desaloja los mensajes de otro), acotado por
+# cantidad y bytes. Con spill, cada texto se guarda además encriptado en SQLite
+# (write-behind) y los que salieron del LRU se buscan ahí por _WA_QUOTE_RETENTION_SECS.
+_WA_QUOTE_MAX = int(os.environ.get("LOLA_QUOTE_MAX_PER_NUMBER", "500"))
+_WA_QUOTE_MB = float(os.environ.get("LOLA_QUOTE_MB_PER_NUMBER", "1"))
+_WA_QUOTE_SPILL = os.environ.get("LOLA_QUOTE_SPILL", "1") == "1"
+_WA_QUOTE_RETENTION_SECS = int(os.environ.get("LOLA_QUOTE_RETENTION_HOURS", "48")) * 3600
+_WA_QUOTE_PURGE_EVERY_SECS = 3600
+_wa_quotes = {}  # phone_number_id → _LRUCache
+_wa_quotes_lock = threading.Lock()
+_wa_quote_stats = {"spilled": 0, "disk_hits": 0, "disk_misses": 0}
+
+
+def _wa_quote_index(phone_number_id):
+    """LRU de quotes de un número (se crea al primer uso)."""
+    idx = _wa_quotes.get(phone_number_id)
+    if idx is None:
+        with _wa_quotes_lock:
+            idx = _wa_quotes.get(phone_number_id)
+            if idx is None:
+                idx = _wa_quotes[phone_number_id] = _LRUCache(
+                    max_items=_WA_QUOTE_MAX, max_bytes=int(_WA_QUOTE_MB * 1024 * 1024))
+    return idx
+
+
+def _wa_quote_put(phone_number_id, msg_id, text):
+    """Guarda el texto de un mensaje (entrante o enviado) para futuros quote replies."""
+    text = text[:500]
+    _wa_quote_index(phone_number_id).put(msg_id, text, size=len(text) + 64)
+    if _WA_QUOTE_SPILL:
+        _db_write_async(
+            "INSERT OR REPLACE INTO quote_texts (msg_id, phone_number_id, text, ts) VALUES (?, ?, ?, ?)",
+            (msg_id, phone_number_id, _encrypt(text), time.time()),
+            desc="quote text",
+        )
+        with _wa_quotes_lock:
+            _wa_quote_stats["spilled"] += 1
+
+
+def _wa_quote_get(phone_number_id, msg_id):
+    """Texto de un mensaje citado, o None. Busca en el LRU del número y después en SQLite."""
+    idx = _wa_quote_index(phone_number_id)
+    text = idx.get(msg_id)
+    if text is not None or not _WA_QUOTE_SPILL:
+        return text
+    # Un quote que no se encuentra solo pierde contexto: un error de SQLite no
+    # tiene que romper el webhook
+    try:
+        with _db_read() as conn:
+            row = conn.execute(
+                "SELECT text FROM quote_texts WHERE msg_id = ? AND phone_number_id = ? AND ts >= ?",
+                (msg_id, phone_number_id, time.time() - _WA_QUOTE_RETENTION_SECS),
+            ).fetchone()
+        text = _decrypt(row["text"]) if row else None
+    except Exception as e:
+        print(f"[WhatsApp] Error leyendo quote {msg_id}: {e}")
+        return None
+    with _wa_quotes_lock:
+        _wa_quote_stats["disk_hits" if text is not None else "disk_misses"] += 1
+    if text is None:
+        return None
+    idx.put(msg_id, text, size=len(text) + 64)
+    return text
+
+
+def _wa_quote_purge_expired():
+    """Borra de SQLite los quotes más viejos que _WA_QUOTE_RETENTION_SECS y se vuelve
+    a agendar cada _WA_QUOTE_PURGE_EVERY_SECS."""
+    _scheduler.call_later(_WA_QUOTE_PURGE_EVERY_SECS, _wa_quote_purge_expired, key="quote-purge")
+    return _db_write_async("DELETE FROM quote_texts WHERE ts < ?",
+                           (time.time() - _WA_QUOTE_RETENTION_SECS,), desc="purga de quotes")
+
+
+def _wa_quote_metrics():
+    """Snapshot del índice de quotes (por número + spill a disco)."""
+    with _wa_quotes_lock:
+        indexes = dict(_wa_quotes)
+        stats = dict(_wa_quote_stats)
+    stats["spill"] = _WA_QUOTE_SPILL
+    stats["numbers"] = {pnid: idx.stats() for pnid, idx in indexes.items()}
+    return stats
+
+
+# Clasificación previa de los cambios del webhook: la mayoría son statuses
+# (sent/delivered/read) que no llevan mensajes; se cuentan en un sink liviano sin
+# resolver el tenant (ni tocar la tabla de routing o SQLite).
+_WA_MSG_TYPES = ("text", "audio", "image", "location")
+_wa_webhook_stats = {
+    "changes": 0, "message_changes": 0, "status_changes": 0, "other_changes": 0,
+    "statuses": {}, "failed_statuses": 0,
+}
+_wa_webhook_stats_lock = threading.Lock()
+
+
+def _wa_webhook_has_messages(value):
+    """True si el cambio trae al menos un mensaje de un tipo que se procesa."""
+    for msg in value.get("messages") or ():
+        if msg.get("type", "") in _WA_MSG_TYPES:
+            return True
+    return False
+
+
+def _wa_status_sink(phone_number_id, value):
+    """Registra un cambio sin mensajes procesables (statuses, tipos no soportados...)."""
+    statuses = value.get("statuses") or ()
+    failed = [st for st in statuses if st.get("status") == "failed"]
+    with _wa_webhook_stats_lock:
+        _wa_webhook_stats["changes"] += 1
+        _wa_webhook_stats["status_changes" if statuses else "other_changes"] += 1
+        counts = _wa_webhook_stats["statuses"]
+        for st in statuses:
+            name = st.get("status", "?")
+            counts[name] = counts.get(name, 0) + 1
+        _wa_webhook_stats["failed_statuses"] += len(failed)
+    for st in failed:
+        errors = st.get("errors") or [{}]
+        print(f"[WhatsApp] Envío fallido a {st.get('recipient_id', '?')} desde {phone_number_id}: "
+              f"{errors[0].get('code', '?')} {errors[0].get('title', '')}")
+
+
+def _wa_webhook_metrics():
+    with _wa_webhook_stats_lock:
+        stats = dict(_wa_webhook_stats)
+        stats["statuses"] = dict(stats["statuses"])
+    # Cada cambio que terminó en el sink es una resolución de tenant que no se hizo
+    stats["route_lookups_skipped"] = stats["status_changes"] + stats["other_changes"]
+    return stats
 
-# Mapeo msg_id → texto para resolver quote replies
-_wa_msg_texts = {}
-_WA_MSG_TEXTS_MAX = 200  # máximo de mensajes en memoria
 
 # Debounce: acumular mensajes por número antes de procesarlos
-# _wa_pending[number] = {"msgs": [...], "timer": Timer, "first_msg_id": str}
+# _wa_pending[number] = {"msgs": [...], "first_msg_id": str, "wa_ctx": ...}
+# El deadline del flush vive en _scheduler con key ("wa-flush", number)
 _wa_pending = {}
 _wa_pending_lock = threading.Lock()
 _WA_DEBOUNCE_SECS = 5  # esperar 5s después del primer mensaje
@@ -1077,15 +2955,23 @@ def _wa_queue_message(from_number, msg_id, msg_data, wa_ctx=None):
     # Typing indicator con el primer msg_id (fuera del lock)
     if msg_id:
         _wa_typing(from_number, msg_id, wa_ctx)
-    timer = threading.Timer(_WA_DEBOUNCE_SECS, _wa_flush, args=(from_number,))
-    timer.daemon = True
-    with _wa_pending_lock:
-        if from_number in _wa_pending:
-            _wa_pending[from_number]["timer"] = timer
-    timer.start()
+    _wa_start_debounce(from_number)
     print(f"[WhatsApp] Timer de {_WA_DEBOUNCE_SECS}s iniciado para {from_number}")
 
 
+def _wa_start_debounce(from_number):
+    """Agenda el flush de un número en el scheduler; al vencer, el flush va al pool."""
+    _scheduler.call_later(_WA_DEBOUNCE_SECS, _wa_submit_flush, from_number, key=("wa-flush", from_number))
+
+
+def _wa_submit_flush(from_number):
+    """Manda el flush de un número al pool. Si la cola está llena, los mensajes
+    quedan en _wa_pending (siguen acumulando) y se reintenta en otro debounce."""
+    if not _wa_pool.submit(_wa_flush, from_number):
+        print(f"[WhatsApp] Pool lleno, reintentando flush de {from_number} en {_WA_DEBOUNCE_SECS}s")
+        _wa_start_debounce(from_number)
+
+
 def _wa_flush(from_number):
     """Procesa todos los mensajes acumulados de un número."""
     with _wa_pending_lock:
@@ -1119,89 +3005,559 @@ def _wa_flush(from_number):
 
 
 # Historial para chat web de Lola (por session_id)
-_lola_web_history = {}
-_LOLA_WEB_HISTORY_MAX = 20
+_LOLA_WEB_HISTORY_MAX = 60
 _LOLA_WEB_HISTORY_TTL = 30 * 60  # 30 min
 
 
 def _wa_get_history(number):
     """Devuelve el historial de un número, limpiando si expiró."""
-    entry = _wa_history.get(number)
-    if entry and (time.time() - entry["ts"]) > _WA_HISTORY_TTL:
-        del _wa_history[number]
-        return []
-    return entry["messages"] if entry else []
+    return _conv_get("wa", number, _WA_HISTORY_TTL)
 
 
 def _wa_append(number, role, text):
     """Agrega un mensaje al historial de un número."""
-    if number not in _wa_history:
-        _wa_history[number] = {"messages": [], "ts": time.time()}
-    entry = _wa_history[number]
-    entry["ts"] = time.time()
-    entry["messages"].append({"role": role, "text": text})
-    # Recortar si excede el máximo (sacamos los más viejos, de a pares)
-    while len(entry["messages"]) > _WA_HISTORY_MAX:
-        entry["messages"].pop(0)
+    _conv_append("wa", number, role, text, _WA_HISTORY_TTL, _WA_HISTORY_MAX)
+
+
+# Media entrante: se baja en streaming a un SpooledTemporaryFile (en RAM hasta
+# _MEDIA_SPOOL_KB, después a disco) con tope duro de tamaño, y el base64 para el
+# LLM se arma por bloques leyendo del spool, sin tener los bytes crudos enteros en memoria.
+_MEDIA_MAX_BYTES = int(float(os.environ.get("LOLA_MEDIA_MAX_MB", "16")) * 1024 * 1024)
+_MEDIA_SPOOL_BYTES = int(os.environ.get("LOLA_MEDIA_SPOOL_KB", "256")) * 1024
+_MEDIA_CHUNK = 3 * 64 * 1024  # múltiplo de 3: cada bloque se codifica sin padding
+_media_stats = {"downloaded": 0, "bytes_total": 0, "spooled_to_disk": 0, "rejected_too_large": 0, "peak_bytes_max": 0}
+_media_stats_lock = threading.Lock()
+
+
+class _MediaTooLarge(Exception):
+    pass
+
+
+class _WaMedia:
+    """Archivo multimedia descargado (spool en RAM/disco) o abierto del cache de media,
+    + mime y sha256 del contenido. Usar con `with` o close()."""
+
+    def __init__(self, media_id, mime_type, cached_path=None, size=0, sha256=""):
+        self.media_id = media_id
+        self.mime_type = mime_type
+        self.size = size
+        self.peak_bytes = 0  # máximo estimado de bytes de este media en RAM a la vez
+        self.from_cache = cached_path is not None
+        self.file = tempfile.SpooledTemporaryFile(max_size=_MEDIA_SPOOL_BYTES, prefix="lola-media-")
+        if self.from_cache:
+            self.sha256 = sha256
+            self._hash = None
+            try:
+                _media_cache_decrypt(cached_path, self.file)
+            except Exception:
+                self.file.close()
+                raise
+        else:
+            self._hash = hashlib.sha256()
+
+    @property
+    def on_disk(self):
+        # SpooledTemporaryFile sabe si pasó a disco; cualquier otro archivo ya lo está
+        return bool(getattr(self.file, "_rolled", True))
+
+    def replace(self, file, size, mime_type):
+        """Cambia el contenido por una versión procesada (el cache conserva el original)."""
+        self.file.close()
+        self.file = file
+        self.size = size
+        self.mime_type = mime_type
+
+    def write(self, chunk):
+        if self.size + len(chunk) > _MEDIA_MAX_BYTES:
+            raise _MediaTooLarge(f"{self.media_id} supera {_MEDIA_MAX_BYTES} bytes")
+        self.file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        self._note_peak(len(chunk))
+
+    @property
+    def sha256_hex(self):
+        return self.sha256 if self._hash is None else self._hash.hexdigest()
+
+    def _note_peak(self, extra):
+        resident = (0 if self.on_disk else self.size) + extra
+        if resident > self.peak_bytes:
+            self.peak_bytes = resident
+
+    def b64(self):
+        """Base64 del contenido como str, codificado por bloques desde el spool."""
+        self.file.seek(0)
+        parts = []
+        encoded = 0
+        while True:
+            chunk = self.file.read(_MEDIA_CHUNK)
+            if not chunk:
+                break
+            part = base64.b64encode(chunk).decode("ascii")
+            parts.append(part)
+            encoded += len(part)
+            self._note_peak(encoded + len(chunk))
+        # El join duplica por un momento el texto codificado
+        self._note_peak(2 * encoded)
+        return "".join(parts)
+
+    def read(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _media_record(media):
+    """Suma un media procesado (descargado y codificado) a las métricas."""
+    with _media_stats_lock:
+        _media_stats["downloaded"] += 1
+        _media_stats["bytes_total"] += media.size
+        if media.on_disk:
+            _media_stats["spooled_to_disk"] += 1
+        if media.peak_bytes > _media_stats["peak_bytes_max"]:
+            _media_stats["peak_bytes_max"] = media.peak_bytes
+
+
+def _media_metrics():
+    with _media_stats_lock:
+        stats = dict(_media_stats)
+    stats["max_bytes"] = _MEDIA_MAX_BYTES
+    stats["spool_bytes"] = _MEDIA_SPOOL_BYTES
+    return stats
+
+
+# Cache de media en disco, direccionado por contenido: media_id → sha256 → archivo
+# ~/.lola-media-cache/<sha256>. Un webhook reenviado (mismo media_id) sale del disco
+# sin ir a Graph; el mismo contenido con otro media_id comparte archivo. LRU por
+# último uso, acotado en bytes (de contenido); el índice vive en memoria y se
+# persiste en SQLite. Como el resto de los datos de clientes, los archivos van
+# encriptados con la master key: bloques Fernet con prefijo de largo.
+_MEDIA_CACHE_DIR = os.path.expanduser("~/.lola-media-cache")
+_MEDIA_CACHE_BYTES = int(float(os.environ.get("LOLA_MEDIA_CACHE_MB", "128")) * 1024 * 1024)
+_media_cache_index = OrderedDict()  # media_id → (sha256, mime_type, size), LRU
+_media_cache_refs = {}  # sha256 → [cantidad de media_ids, size]
+_media_cache_lock = threading.Lock()
+_media_cache_stats = {"hits": 0, "misses": 0, "bytes_saved": 0, "stored": 0, "dedup": 0, "evictions": 0}
+_media_cache_bytes = 0
+
+
+def _media_cache_path(sha256):
+    return os.path.join(_MEDIA_CACHE_DIR, sha256)
+
+
+def _media_cache_encrypt(src, dst):
+    """Copia src (desde el principio) a dst encriptando por bloques de _MEDIA_CHUNK."""
+    src.seek(0)
+    while True:
+        chunk = src.read(_MEDIA_CHUNK)
+        if not chunk:
+            break
+        token = _fernet.encrypt(chunk)
+        dst.write(len(token).to_bytes(4, "big"))
+        dst.write(token)
+
+
+def _media_cache_decrypt(path, dst):
+    """Desencripta el archivo del cache en dst. InvalidToken/ValueError si está
+    corrupto o no es del formato encriptado."""
+    with open(path, "rb") as f:
+        while True:
+            head = f.read(4)
+            if not head:
+                break
+            n = int.from_bytes(head, "big")
+            token = f.read(n)
+            if len(head) < 4 or len(token) < n:
+                raise ValueError(f"bloque truncado en {os.path.basename(path)}")
+            dst.write(_fernet.decrypt(token))
+    dst.seek(0)
+
+
+def _media_cache_load():
+    """Reconstruye el índice desde SQLite y borra archivos huérfanos. Retorna la cantidad."""
+    global _media_cache_bytes
+    if not _MEDIA_CACHE_BYTES:
+        return 0
+    os.makedirs(_MEDIA_CACHE_DIR, mode=0o700, exist_ok=True)
+    with _db_read() as conn:
+        rows = conn.execute(
+            "SELECT media_id, sha256, mime_type, size FROM media_cache ORDER BY last_used"
+        ).fetchall()
+    missing = []
+    with _media_cache_lock:
+        for r in rows:
+            if not os.path.exists(_media_cache_path(r["sha256"])):
+                missing.append(r["media_id"])
+                continue
+            _media_cache_index[r["media_id"]] = (r["sha256"], r["mime_type"], r["size"])
+            ref = _media_cache_refs.setdefault(r["sha256"], [0, r["size"]])
+            if not ref[0]:
+                _media_cache_bytes += r["size"]
+            ref[0] += 1
+        known = set(_media_cache_refs)
+    if missing:
+        _db_write_async("DELETE FROM media_cache WHERE media_id = ?", [(m,) for m in missing], many=True,
+                        desc="media_cache sin archivo")
+    for name in os.listdir(_MEDIA_CACHE_DIR):
+        if name not in known:
+            try:
+                os.remove(os.path.join(_MEDIA_CACHE_DIR, name))
+            except OSError:
+                pass
+    _media_cache_evict()
+    return len(_media_cache_index)
+
+
+def _media_cache_get(media_id):
+    """_WaMedia abierto desde el cache, o None."""
+    if not _MEDIA_CACHE_BYTES:
+        return None
+    with _media_cache_lock:
+        entry = _media_cache_index.get(media_id)
+        if entry is None:
+            _media_cache_stats["misses"] += 1
+            return None
+        _media_cache_index.move_to_end(media_id)
+        sha256, mime_type, size = entry
+    try:
+        media = _WaMedia(media_id, mime_type, cached_path=_media_cache_path(sha256), size=size, sha256=sha256)
+    except (OSError, ValueError, InvalidToken) as e:
+        # Archivo borrado, corrupto o de antes de encriptar el cache: se vuelve a bajar
+        print(f"[MediaCache] Descartando {media_id}: {e or type(e).__name__}")
+        _media_cache_drop(media_id)
+        return None
+    with _media_cache_lock:
+        _media_cache_stats["hits"] += 1
+        _media_cache_stats["bytes_saved"] += size
+    _db_write_async("UPDATE media_cache SET last_used = ? WHERE media_id = ?", (time.time(), media_id),
+                    desc="media_cache uso")
+    return media
+
+
+def _media_cache_put(media):
+    """Guarda un media recién descargado. Si el contenido ya estaba (otro media_id),
+    solo suma la referencia; si no, copia el spool a <dir>/<sha256>."""
+    global _media_cache_bytes
+    if not _MEDIA_CACHE_BYTES or media.size > _MEDIA_CACHE_BYTES:
+        return
+    sha256 = media.sha256_hex
+    path = _media_cache_path(sha256)
+    with _media_cache_lock:
+        if media.media_id in _media_cache_index:
+            return
+        have_blob = sha256 in _media_cache_refs
+    if not have_blob:
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(_MEDIA_CACHE_DIR, mode=0o700, exist_ok=True)
+            with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as out:
+                _media_cache_encrypt(media.file, out)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[MediaCache] Error guardando {media.media_id}: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+    with _media_cache_lock:
+        if media.media_id in _media_cache_index:
+            return
+        _media_cache_index[media.media_id] = (sha256, media.mime_type, media.size)
+        ref = _media_cache_refs.setdefault(sha256, [0, media.size])
+        if ref[0]:
+            _media_cache_stats["dedup"] += 1
+        else:
+            _media_cache_bytes += media.size
+        ref[0] += 1
+        _media_cache_stats["stored"] += 1
+    _db_write_async(
+        "INSERT OR REPLACE INTO media_cache (media_id, sha256, mime_type, size, last_used) VALUES (?, ?, ?, ?, ?)",
+        (media.media_id, sha256, media.mime_type, media.size, time.time()),
+        desc="media_cache",
+    )
+    _media_cache_evict()
+
+
+def _media_cache_drop(media_id, evicted=False):
+    """Saca un media_id del índice; borra el archivo si era la última referencia."""
+    global _media_cache_bytes
+    with _media_cache_lock:
+        entry = _media_cache_index.pop(media_id, None)
+        if entry is None:
+            return
+        if evicted:
+            _media_cache_stats["evictions"] += 1
+        ref = _media_cache_refs[entry[0]]
+        ref[0] -= 1
+        orphan = ref[0] <= 0
+        if orphan:
+            del _media_cache_refs[entry[0]]
+            _media_cache_bytes -= ref[1]
+    if orphan:
+        try:
+            os.remove(_media_cache_path(entry[0]))
+        except OSError:
+            pass
+    _db_write_async("DELETE FROM media_cache WHERE media_id = ?", (media_id,), desc="media_cache evict")
+
+
+def _media_cache_evict():
+    """Desaloja por LRU hasta quedar dentro de _MEDIA_CACHE_BYTES."""
+    while True:
+        with _media_cache_lock:
+            if _media_cache_bytes <= _MEDIA_CACHE_BYTES or not _media_cache_index:
+                return
+            oldest = next(iter(_media_cache_index))
+        _media_cache_drop(oldest, evicted=True)
+
+
+def _media_cache_metrics():
+    with _media_cache_lock:
+        stats = dict(_media_cache_stats)
+        stats["items"] = len(_media_cache_index)
+        stats["blobs"] = len(_media_cache_refs)
+        stats["bytes"] = _media_cache_bytes
+    stats["max_bytes"] = _MEDIA_CACHE_BYTES
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+    return stats
+
+
+# Preproceso antes del LLM: fotos reescaladas a _IMAGE_MAX_DIM px en JPEG (Pillow;
+# también las chicas de dimensión pero pesadas, ej. un PNG de 9 MB) y
+# audios grandes recodificados a Opus mono 16 kHz y recortados (ffmpeg). Si falta la
+# herramienta, o el resultado no es más chico, se manda el original. Cada número
+# puede desactivarlo (wa_numbers.media_preprocess = 0) si necesita fidelidad total.
+_MEDIA_PREPROCESS = os.environ.get("LOLA_MEDIA_PREPROCESS", "1") == "1"
+_IMAGE_MAX_DIM = int(os.environ.get("LOLA_IMAGE_MAX_DIM", "1536"))
+_IMAGE_QUALITY = int(os.environ.get("LOLA_IMAGE_QUALITY", "80"))
+_IMAGE_MAX_BYTES = int(os.environ.get("LOLA_IMAGE_MAX_KB", "1024")) * 1024
+_AUDIO_MAX_BYTES = int(os.environ.get("LOLA_AUDIO_MAX_KB", "512")) * 1024
+_AUDIO_MAX_SECS = int(os.environ.get("LOLA_AUDIO_MAX_SECS", "300"))
+_FFMPEG = shutil.which("ffmpeg")
+_preprocess_stats = {
+    "images": 0, "audios": 0, "bytes_in": 0, "bytes_out": 0, "bytes_saved": 0,
+    "unchanged": 0, "opted_out": 0, "errors": 0,
+}
+_preprocess_lock = threading.Lock()
+
+
+def _media_preprocess_image(media):
+    """Reescala una foto a _IMAGE_MAX_DIM y la recomprime (o solo la recomprime si las
+    dimensiones entran pero pesa más de _IMAGE_MAX_BYTES). Retorna (file, size, mime) o None."""
+    if Image is None:
+        return None
+    media.file.seek(0)
+    with Image.open(media.file) as img:
+        if max(img.size) <= _IMAGE_MAX_DIM and media.size <= _IMAGE_MAX_BYTES:
+            return None
+        img.draft("RGB", (_IMAGE_MAX_DIM, _IMAGE_MAX_DIM))  # JPEG: decodifica ya reducido
+        img = ImageOps.exif_transpose(img)
+        # JPEG no tiene alfa: con convert("RGB") lo transparente queda del color que
+        # haya abajo (muchas veces negro). Se compone sobre blanco.
+        alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+        img = img.convert("RGBA" if alpha else "RGB")
+        img.thumbnail((_IMAGE_MAX_DIM, _IMAGE_MAX_DIM))
+        if alpha:
+            flat = Image.new("RGB", img.size, (255, 255, 255))
+            flat.paste(img, mask=img.getchannel("A"))
+            img = flat
+        out = tempfile.SpooledTemporaryFile(max_size=_MEDIA_SPOOL_BYTES, prefix="lola-media-")
+        img.save(out, "JPEG", quality=_IMAGE_QUALITY, optimize=True)
+    return out, out.tell(), "image/jpeg"
+
+
+def _media_preprocess_audio(media):
+    """Recodifica un audio grande a Opus mono 16 kHz, recortado a _AUDIO_MAX_SECS.
+    Retorna (file, size, mime) o None."""
+    if not _FFMPEG or media.size <= _AUDIO_MAX_BYTES:
+        return None
+    media.file.seek(0)
+    out = tempfile.TemporaryFile(prefix="lola-media-")
+    try:
+        # stdin=archivo: fileno() pasa el spool a disco y ffmpeg lee sin copiarlo a Python
+        result = subprocess.run(
+            [_FFMPEG, "-hide_banner", "-loglevel", "error", "-i", "pipe:0", "-t", str(_AUDIO_MAX_SECS),
+             "-vn", "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", "24k", "-f", "ogg", "pipe:1"],
+            stdin=media.file, stdout=out, stderr=subprocess.PIPE, timeout=60,
+        )
+    except Exception:
+        out.close()
+        raise
+    if result.returncode != 0:
+        out.close()
+        raise RuntimeError(f"ffmpeg: {result.stderr.decode('utf-8', errors='replace')[:200]}")
+    return out, out.tell(), "audio/ogg"
+
+
+def _media_preprocess(media, wa_ctx=None):
+    """Aplica el preproceso que corresponda al media (in place). Retorna los bytes ahorrados."""
+    if not _MEDIA_PREPROCESS:
+        return 0
+    if not (wa_ctx or {}).get("media_preprocess", True):
+        with _preprocess_lock:
+            _preprocess_stats["opted_out"] += 1
+        return 0
+    kind = media.mime_type.split("/", 1)[0]
+    original = media.size
+    try:
+        if kind == "image":
+            processed = _media_preprocess_image(media)
+        elif kind == "audio":
+            processed = _media_preprocess_audio(media)
+        else:
+            processed = None
+    except Exception as e:
+        with _preprocess_lock:
+            _preprocess_stats["errors"] += 1
+        print(f"[Media] Error preprocesando {media.media_id} ({media.mime_type}): {e}")
+        return 0
+    if processed is None or processed[1] >= original:
+        if processed is not None:
+            processed[0].close()
+        with _preprocess_lock:
+            _preprocess_stats["unchanged"] += 1
+        return 0
+    media.replace(*processed)
+    saved = original - media.size
+    with _preprocess_lock:
+        _preprocess_stats["images" if kind == "image" else "audios"] += 1
+        _preprocess_stats["bytes_in"] += original
+        _preprocess_stats["bytes_out"] += media.size
+        _preprocess_stats["bytes_saved"] += saved
+    print(f"[Media] {media.media_id}: {original} → {media.size} bytes ({media.mime_type}, -{saved * 100 // original}%)")
+    return saved
+
+
+def _media_preprocess_metrics():
+    with _preprocess_lock:
+        stats = dict(_preprocess_stats)
+    stats["enabled"] = _MEDIA_PREPROCESS
+    stats["pillow"] = Image is not None
+    stats["ffmpeg"] = bool(_FFMPEG)
+    stats["image_max_dim"] = _IMAGE_MAX_DIM
+    stats["image_max_bytes"] = _IMAGE_MAX_BYTES
+    stats["audio_max_bytes"] = _AUDIO_MAX_BYTES
+    return stats
 
 
 def _wa_download_media(media_id, wa_ctx=None):
-    """Descarga un archivo multimedia de WhatsApp. Retorna (bytes, mime_type) o (None, None)."""
+    """Descarga un archivo multimedia de WhatsApp en streaming (o lo abre del cache de
+    media). Retorna un _WaMedia (el que llama lo cierra) o None si falló o supera
+    _MEDIA_MAX_BYTES."""
+    cached = _media_cache_get(media_id)
+    if cached is not None:
+        return cached
     token = (wa_ctx or {}).get("access_token") or (WA_CONFIG or {}).get("access_token")
     if not token:
-        return None, None
+        return None
+    headers = {"Authorization": f"Bearer {token}"}
     # Paso 1: obtener la URL del media
-    url = f"https://graph.facebook.com/v23.0/{media_id}"
-    req = urllib.request.Request(url)
-    req.add_header("Authorization", f"Bearer {token}")
+    url = f"{_GRAPH_BASE}/{media_id}"
+    media = None
     try:
-        with urllib.request.urlopen(req, timeout=15) as resp:
-            info = json.loads(resp.read())
+        status, body = _http_request("GET", url, headers=headers, timeout=15)
+        if not _http_ok(status):
+            print(f"[WhatsApp] Error obteniendo media {media_id}: {status}")
+            return None
+        info = json.loads(body)
         media_url = info.get("url")
         mime_type = info.get("mime_type", "audio/ogg")
         if not media_url:
-            return None, None
-        # Paso 2: descargar el archivo
-        req2 = urllib.request.Request(media_url)
-        req2.add_header("Authorization", f"Bearer {token}")
-        with urllib.request.urlopen(req2, timeout=30) as resp2:
-            return resp2.read(), mime_type
+            return None
+        if int(info.get("file_size") or 0) > _MEDIA_MAX_BYTES:
+            raise _MediaTooLarge(f"{media_id} declara {info['file_size']} bytes")
+        # Paso 2: descargar el archivo por bloques al spool. Se sigue un redirect
+        # (sin el token si cambia de host); el body de un 3xx nunca se toma como media.
+        media = _WaMedia(media_id, mime_type)
+        for hop in (0, 1):
+            with _http_open("GET", media_url, headers=headers, timeout=30) as resp:
+                location = resp.getheader("Location")
+                if 300 <= resp.status < 400 and location and hop == 0:
+                    resp.read()
+                    next_url = urljoin(media_url, location)
+                    if urlparse(next_url).hostname != urlparse(media_url).hostname:
+                        headers = {}
+                    media_url = next_url
+                    continue
+                if not _http_ok(resp.status):
+                    print(f"[WhatsApp] Error descargando media {media_id}: {resp.status}")
+                    media.close()
+                    return None
+                if int(resp.getheader("Content-Length") or 0) > _MEDIA_MAX_BYTES:
+                    raise _MediaTooLarge(f"{media_id} trae Content-Length {resp.getheader('Content-Length')}")
+                while True:
+                    chunk = resp.read(_MEDIA_CHUNK)
+                    if not chunk:
+                        break
+                    media.write(chunk)
+            break
+        _media_cache_put(media)
+        return media
+    except _MediaTooLarge as e:
+        with _media_stats_lock:
+            _media_stats["rejected_too_large"] += 1
+        print(f"[WhatsApp] Media descartado por tamaño: {e}")
     except Exception as e:
         print(f"[WhatsApp] Error descargando media {media_id}: {e}")
-        return None, None
+    if media is not None:
+        media.close()
+    return None
 
 
 def _wa_typing(to, msg_id="", wa_ctx=None):
+    """Encola 'escribiendo...' + leído, en orden con los envíos a `to`."""
+    phone_number_id, access_token = _wa_creds(wa_ctx)
+    if not phone_number_id or not access_token or not msg_id:
+        return
+    _wa_outbox.put(phone_number_id, to, _wa_typing_now, to, msg_id, wa_ctx, kind="typing")
+
+
+def _wa_typing_now(to, msg_id="", wa_ctx=None):
     """Muestra 'escribiendo...' y marca el mensaje como leído."""
-    phone_number_id = (wa_ctx or {}).get("phone_number_id") or (WA_CONFIG or {}).get("phone_number_id")
-    access_token = (wa_ctx or {}).get("access_token") or (WA_CONFIG or {}).get("access_token")
+    phone_number_id, access_token = _wa_creds(wa_ctx)
     if not phone_number_id or not access_token or not msg_id:
         return
-    url = f"https://graph.facebook.com/v23.0/{phone_number_id}/messages"
+    url = f"{_GRAPH_BASE}/{phone_number_id}/messages"
     data = {
         "messaging_product": "whatsapp",
         "status": "read",
         "message_id": msg_id,
         "typing_indicator": {"type": "text"},
     }
-    payload = json.dumps(data).encode("utf-8")
-    req = urllib.request.Request(url, data=payload, method="POST")
-    req.add_header("Content-Type", "application/json")
-    req.add_header("Authorization", f"Bearer {access_token}")
     try:
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            pass
+        status, _ = _graph_post(url, data, access_token, timeout=10)
+        if not _http_ok(status):
+            print(f"[WhatsApp] Error typing indicator: HTTP {status}")
+        return status
     except Exception as e:
         print(f"[WhatsApp] Error typing indicator: {e}")
+        return None  # no se reintenta, ver _WA_NO_RETRY_KINDS
 
 
 def _wa_react(to, msg_id, emoji, wa_ctx=None):
+    """Encola una reacción, en orden con los envíos a `to`."""
+    phone_number_id, access_token = _wa_creds(wa_ctx)
+    if not phone_number_id or not access_token or not msg_id:
+        return
+    _wa_outbox.put(phone_number_id, to, _wa_react_now, to, msg_id, emoji, wa_ctx, kind="reaction")
+
+
+def _wa_react_now(to, msg_id, emoji, wa_ctx=None):
     """Reacciona a un mensaje con un emoji."""
-    phone_number_id = (wa_ctx or {}).get("phone_number_id") or (WA_CONFIG or {}).get("phone_number_id")
-    access_token = (wa_ctx or {}).get("access_token") or (WA_CONFIG or {}).get("access_token")
+    phone_number_id, access_token = _wa_creds(wa_ctx)
     if not phone_number_id or not access_token or not msg_id:
         return
-    url = f"https://graph.facebook.com/v23.0/{phone_number_id}/messages"
+    url = f"{_GRAPH_BASE}/{phone_number_id}/messages"
     data = {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
@@ -1209,15 +3565,17 @@ def _wa_react(to, msg_id, emoji, wa_ctx=None):
         "type": "reaction",
         "reaction": {"message_id": msg_id, "emoji": emoji},
     }
-    payload = json.dumps(data).encode("utf-8")
-    req = urllib.request.Request(url, data=payload, method="POST")
-    req.add_header("Content-Type", "application/json")
-    req.add_header("Authorization", f"Bearer {access_token}")
     try:
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            pass
+        status, _ = _graph_post(url, data, access_token, timeout=10)
+        if not _http_ok(status):
+            print(f"[WhatsApp] Error reacción: HTTP {status}")
+        return status
+    except (TimeoutError, _HTTPNoResponse) as e:
+        print(f"[WhatsApp] Sin respuesta en reacción: {e}")
+        return None
     except Exception as e:
         print(f"[WhatsApp] Error reacción: {e}")
+        return 0
 
 
 # Reacciones — se elige una al azar
@@ -1237,56 +3595,178 @@ def _time_period():
         return "madrugada"
 
 
+# ═══════════════ PROMPTS COMPILADOS ═══════════════
+# El system prompt final (prompt del tenant + contexto de horario) se arma una vez
+# por (tenant, período del día) y se reusa: texto internado, sha256 para keys de
+# cache y estimación de tokens ya calculada. Se recompila cuando cambia el prompt
+# base (tenant re-guardado → wa_ctx nuevo) o cuando rota el período.
+
+_CompiledPrompt = namedtuple("_CompiledPrompt", "text sha tokens base period")
+_PROMPT_CACHE_MAX = int(os.environ.get("LOLA_PROMPT_CACHE_MAX", "4000"))
+_prompt_cache = _LRUCache(max_items=_PROMPT_CACHE_MAX)
+_prompt_stats = {"compiled": 0, "invalidations": 0}
+_prompt_stats_lock = threading.Lock()
+
+
+def _estimate_tokens(text):
+    """Estimación barata de tokens (~4 caracteres por token en español/inglés)."""
+    return (len(text) + 3) // 4
+
+
+def _prompt_compile(base_prompt, period):
+    """Arma el system prompt final para un período del día."""
+    time_ctx = f"\n(Contexto: ahora es de {period} en Uruguay. Saludá acorde si es el primer mensaje.)\n"
+    text = sys.intern(base_prompt + time_ctx)
+    with _prompt_stats_lock:
+        _prompt_stats["compiled"] += 1
+    return _CompiledPrompt(
+        text=text,
+        sha=hashlib.sha256(text.encode("utf-8")).hexdigest()[:16],
+        tokens=_estimate_tokens(text),
+        base=base_prompt,
+        period=period,
+    )
+
+
+def _prompt_get(tenant_key, base_prompt, period=None):
+    """_CompiledPrompt de un tenant para el período actual (o el dado)."""
+    period = period or _time_period()
+    key = (tenant_key, period)
+    compiled = _prompt_cache.get(key)
+    # `is` primero: mientras la ruta no cambie, el wa_ctx trae el mismo objeto str
+    if compiled is not None and (compiled.base is base_prompt or compiled.base == base_prompt):
+        return compiled
+    compiled = _prompt_compile(base_prompt, period)
+    _prompt_cache.put(key, compiled)
+    return compiled
+
+
+def _prompt_invalidate(tenant_key):
+    """Descarta los prompts compilados de un tenant (todos los períodos)."""
+    for period in ("mañana", "tarde", "noche", "madrugada"):
+        _prompt_cache.invalidate((tenant_key, period))
+    with _prompt_stats_lock:
+        _prompt_stats["invalidations"] += 1
+
+
+def _prompt_metrics():
+    with _prompt_stats_lock:
+        stats = dict(_prompt_stats)
+    stats.update(_prompt_cache.stats())
+    return stats
+
+
+# ═══════════════ CACHE DE RESPUESTAS ═══════════════
+# Las preguntas de primer turno (horarios, dirección, envíos...) se responden solo
+# con el system_prompt del tenant, así que la misma pregunta con el mismo prompt y
+# período del día da la misma respuesta: se cachea el texto crudo del LLM (con tags
+# sin procesar) y se ahorra una request al pool de keys. Los tags y el pacing se
+# aplican igual sobre la respuesta cacheada.
+
+_ANSWER_CACHE_TTL = int(os.environ.get("LOLA_ANSWER_CACHE_TTL", str(6 * 3600)))
+_ANSWER_CACHE_MAX = int(os.environ.get("LOLA_ANSWER_CACHE_MAX", "2000"))
+_ANSWER_CACHE_MAX_QUESTION = 160  # preguntas más largas no son "la pregunta de siempre"
+_answer_cache = _LRUCache(max_items=_ANSWER_CACHE_MAX)
+_answer_cache_gens = {}  # tenant_phone_hash → generación (se incrementa al re-guardar el tenant)
+_answer_cache_stats = {"stored": 0, "expired": 0, "invalidations": 0, "stale_puts": 0}
+_answer_cache_lock = threading.Lock()  # generaciones y stats (el LRU tiene su propio lock)
+
+
+def _answer_normalize(text):
+    """minúsculas, sin tildes ni puntuación, espacios colapsados: "¿Horario?" == "horario"."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c if c.isalnum() else " " for c in text if not unicodedata.combining(c))
+    return " ".join(text.split())
+
+
+def _answer_cache_key(tenant_phone_hash, prompt, question):
+    """Key de cache para una pregunta de primer turno (prompt: _CompiledPrompt), o None
+    si no es cacheable. El sha del prompt compilado ya incluye el período del día."""
+    if not _ANSWER_CACHE_TTL or not _ANSWER_CACHE_MAX:
+        return None
+    q = _answer_normalize(question or "")
+    if not q or len(q) > _ANSWER_CACHE_MAX_QUESTION:
+        return None
+    with _answer_cache_lock:
+        gen = _answer_cache_gens.get(tenant_phone_hash, 0)
+    return (tenant_phone_hash, gen, prompt.sha, q)
+
+
+def _answer_cache_get(key):
+    """Respuesta cruda cacheada para key, o None."""
+    item = _answer_cache.get(key)
+    if item is None:
+        return None
+    reply, expires = item
+    if time.time() > expires:
+        _answer_cache.invalidate(key)
+        with _answer_cache_lock:
+            _answer_cache_stats["expired"] += 1
+        return None
+    return reply
+
+
+def _answer_cache_put(key, reply):
+    """Guarda la respuesta, salvo que el tenant se haya re-guardado mientras se
+    generaba (la key es de una generación vieja: nadie la volvería a leer)."""
+    with _answer_cache_lock:
+        if key[1] != _answer_cache_gens.get(key[0], 0):
+            _answer_cache_stats["stale_puts"] += 1
+            return
+        _answer_cache.put(key, (reply, time.time() + _ANSWER_CACHE_TTL))
+        _answer_cache_stats["stored"] += 1
+
+
+def _answer_cache_invalidate(tenant_phone_hash):
+    """Descarta las respuestas de un tenant (sus entradas viejas salen del LRU solas)."""
+    with _answer_cache_lock:
+        _answer_cache_gens[tenant_phone_hash] = _answer_cache_gens.get(tenant_phone_hash, 0) + 1
+        _answer_cache_stats["invalidations"] += 1
+
+
+def _answer_cache_metrics():
+    with _answer_cache_lock:
+        stats = dict(_answer_cache_stats)
+    stats.update(_answer_cache.stats())
+    stats["ttl"] = _ANSWER_CACHE_TTL
+    return stats
+
+
 # ═══════════════ INSTAGRAM ═══════════════
 
 # Historial de conversaciones por Instagram user ID
-_ig_history = {}
-_IG_HISTORY_MAX = 20
+_IG_HISTORY_MAX = 60
 _IG_HISTORY_TTL = 30 * 60  # 30 min
 
 # Deduplicación de mensajes de Instagram
-_ig_seen_ids = {}
 _IG_SEEN_TTL = 120  # 2 minutos
+_ig_seen_ids = _TTLSet("ig", _IG_SEEN_TTL, persist=_DEDUP_PERSIST)
 
 
 def _ig_get_history(user_id):
     """Devuelve el historial de un usuario de Instagram, limpiando si expiró."""
-    entry = _ig_history.get(user_id)
-    if entry and (time.time() - entry["ts"]) > _IG_HISTORY_TTL:
-        del _ig_history[user_id]
-        return []
-    return entry["messages"] if entry else []
+    return _conv_get("ig", user_id, _IG_HISTORY_TTL)
 
 
 def _ig_append(user_id, role, text):
     """Agrega un mensaje al historial de un usuario de Instagram."""
-    if user_id not in _ig_history:
-        _ig_history[user_id] = {"messages": [], "ts": time.time()}
-    entry = _ig_history[user_id]
-    entry["ts"] = time.time()
-    entry["messages"].append({"role": role, "text": text})
-    while len(entry["messages"]) > _IG_HISTORY_MAX:
-        entry["messages"].pop(0)
+    _conv_append("ig", user_id, role, text, _IG_HISTORY_TTL, _IG_HISTORY_MAX)
 
 
 def _send_instagram(to, text):
     """Envía un mensaje de texto via Instagram Messaging API."""
     if not IG_CONFIG:
         return
-    url = f"https://graph.facebook.com/v23.0/{IG_CONFIG['ig_user_id']}/messages"
-    payload = json.dumps({
-        "recipient": {"id": to},
-        "message": {"text": text},
-    }).encode("utf-8")
-    req = urllib.request.Request(url, data=payload, method="POST")
-    req.add_header("Content-Type", "application/json")
-    req.add_header("Authorization", f"Bearer {IG_CONFIG['access_token']}")
+    url = f"{_GRAPH_BASE}/{IG_CONFIG['ig_user_id']}/messages"
     try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            print(f"[Instagram] Mensaje enviado a {to}: {resp.status}")
-    except urllib.error.HTTPError as e:
-        body = e.read().decode("utf-8", errors="replace")
-        print(f"[Instagram] Error enviando a {to}: {e.code} {body}")
+        status, body = _graph_post(url, {
+            "recipient": {"id": to},
+            "message": {"text": text},
+        }, IG_CONFIG["access_token"], timeout=30)
+        if not _http_ok(status):
+            print(f"[Instagram] Error enviando a {to}: {status} {body.decode('utf-8', errors='replace')}")
+        else:
+            print(f"[Instagram] Mensaje enviado a {to}: {status}")
     except Exception as e:
         print(f"[Instagram] Error enviando a {to}: {e}")
 
@@ -1297,7 +3777,12 @@ def _handle_ig_message(from_id, text):
 
     user_msg = {"role": "user", "text": text or ""}
     _ig_append(from_id, "user", text)
-    messages = history + [user_msg]
+    user_tokens = _turn_tokens_estimate(user_msg["text"])
+    window, history_tokens = _history_window(history, _HISTORY_TOKENS, reserved=user_tokens)
+    messages = window + [user_msg]
+    context_tokens = _estimate_tokens(WA_SYSTEM_PROMPT) + history_tokens + user_tokens
+    _history_record_context(context_tokens)
+    print(f"[Instagram] Contexto para {from_id}: {len(window)}/{len(history)} turnos, ~{context_tokens} tokens")
 
     try:
         result = router.ask_chat(messages, system=WA_SYSTEM_PROMPT, timeout=30)
@@ -1429,39 +3914,129 @@ def _split_reply(text):
     return merged if merged else [text]
 
 
-def _handle_wa_message(from_number, text, msg_id="", media_data=None, media_mime=None, media_label="audio", wa_ctx=None):
-    """Procesa un mensaje de WhatsApp y responde (en thread aparte)."""
-    # Delay variable antes de empezar a tipear (1-3s, como una persona)
-    time.sleep(random.uniform(1.0, 3.0))
+def _wa_split_pausas(reply):
+    """Separa una respuesta por {{PAUSA:N}}. Retorna [(texto, segundos_de_pausa_antes)]."""
+    pausa_parts = re.split(r"\{\{PAUSA:(\d+)\}\}", reply)
+    # pausa_parts: [texto_antes, segundos, texto_despues, ...]
+    segments = []
+    i = 0
+    while i < len(pausa_parts):
+        text_part = pausa_parts[i].strip()
+        if i == 0:
+            if text_part:
+                segments.append((text_part, 0))
+        else:
+            # pausa_parts[i] es el delay, pausa_parts[i+1] es el texto
+            delay_secs = int(pausa_parts[i])
+            i += 1
+            text_part = pausa_parts[i].strip() if i < len(pausa_parts) else ""
+            if text_part:
+                segments.append((text_part, delay_secs))
+        i += 1
+    return segments
+
+
+def _wa_plan_delivery(reply):
+    """Convierte una respuesta en una línea de tiempo de entrega:
+    [(segundos_desde_el_evento_anterior, "typing" | "send", texto)].
+    Las pausas ({{PAUSA:N}}) y el pacing entre chunks quedan como delays, así
+    nadie duerme un thread: los ejecuta el scheduler (ver _wa_deliver)."""
+    events = []
+    for seg_text, seg_delay in _wa_split_pausas(reply):
+        delay = 0
+        if seg_delay > 0:
+            events.append((0, "typing", ""))
+            delay = seg_delay
+        # Dividir en varios mensajes para parecer natural
+        chunks = _split_reply(seg_text)
+        for j, chunk in enumerate(chunks):
+            if j > 0:
+                events.append((0, "typing", ""))
+                delay = min(0.5 + len(chunks[j - 1]) * 0.02, 3.0)
+            events.append((delay, "send", chunk))
+            delay = 0
+    return events
+
+
+def _wa_deliver(to, msg_id, wa_ctx, events):
+    """Arranca la entrega de una línea de tiempo armada por _wa_plan_delivery."""
+    if events:
+        _scheduler.call_later(events[0][0], _wa_deliver_step, to, msg_id, wa_ctx, events, 0)
+
+
+def _wa_deliver_step(to, msg_id, wa_ctx, events, i):
+    """Encola el evento i en la lane del destinatario y agenda el siguiente con su
+    delay. Corre en el thread del scheduler: solo encola, no hace I/O."""
+    _, action, text = events[i]
+    if action == "typing":
+        _wa_typing(to, msg_id, wa_ctx)
+    else:
+        _send_whatsapp(to, text, wa_ctx)
+    if i + 1 < len(events):
+        _scheduler.call_later(events[i + 1][0], _wa_deliver_step, to, msg_id, wa_ctx, events, i + 1)
+
+
+def _handle_wa_message(from_number, text, msg_id="", media=None, media_label="audio", wa_ctx=None):
+    """Procesa un mensaje de WhatsApp (en un worker de _wa_pool): llama al LLM y agenda
+    la entrega de la respuesta. Las demoras humanas no duermen el worker."""
+    # Delay variable antes de empezar a tipear (1-3s, como una persona). El LLM
+    # arranca ya; el typing y el primer envío respetan el delay vía scheduler.
+    human_delay = random.uniform(1.0, 3.0)
+    ready_at = time.monotonic() + human_delay
 
     # Mostrar "escribiendo..." mientras Gemini procesa
+    typing_key = ("wa-typing", from_number, msg_id)
     if msg_id:
-        _wa_typing(from_number, msg_id, wa_ctx)
+        _scheduler.call_later(human_delay, _wa_typing, from_number, msg_id, wa_ctx, key=typing_key)
 
-    # Armar historial multi-turn
+    # Historial multi-turn guardado (la ventana que se manda se arma más abajo)
     history = _wa_get_history(from_number)
 
     # Construir el mensaje del usuario
     user_msg = {"role": "user", "text": text or ""}
-    if media_data:
-        b64 = base64.b64encode(media_data).decode("utf-8")
-        user_msg["parts"] = [{"inline_data": {"mime_type": media_mime, "data": b64}}]
+    if media is not None:
+        # El base64 queda referenciado solo desde el request; el spool se cierra ya
+        with media:
+            user_msg["parts"] = [{"inline_data": {"mime_type": media.mime_type, "data": media.b64()}}]
+        _media_record(media)
+        print(f"[WhatsApp] {media_label.capitalize()} en base64: pico ~{media.peak_bytes // 1024} KB"
+              f"{' (spool en disco)' if media.on_disk else ''}")
         if not text:
             user_msg["text"] = f"(el usuario envió un {media_label})"
 
     _wa_append(from_number, "user", text or f"[{media_label}]")
-    messages = history + [user_msg]
 
-    # Determinar system prompt: del tenant (wa_ctx) o default de Lola ventas
-    system_prompt = (wa_ctx or {}).get("system_prompt") or WA_SYSTEM_PROMPT
+    # System prompt del tenant (wa_ctx) o default de Lola ventas, con el contexto de
+    # horario ya armado para el período actual
+    tenant_phone_hash = (wa_ctx or {}).get("tenant_phone_hash", "")
+    prompt = _prompt_get(tenant_phone_hash, (wa_ctx or {}).get("system_prompt") or WA_SYSTEM_PROMPT)
+    system_prompt = prompt.text
 
-    # Agregar contexto de horario al system prompt
-    period = _time_period()
-    time_ctx = f"\n(Contexto: ahora es de {period} en Uruguay. Saludá acorde si es el primer mensaje.)\n"
-    system_prompt = system_prompt + time_ctx
+    # Ventana de historial dentro del presupuesto de tokens del número
+    user_tokens = _turn_tokens_estimate(user_msg["text"])
+    window, history_tokens = _history_window(
+        history, (wa_ctx or {}).get("history_tokens") or _HISTORY_TOKENS, reserved=user_tokens)
+    messages = window + [user_msg]
+
+    # Primer turno sin media: la respuesta puede salir del cache
+    cache_key = None
+    if not history and "parts" not in user_msg:
+        cache_key = _answer_cache_key(tenant_phone_hash, prompt, text)
+    cached = _answer_cache_get(cache_key) if cache_key else None
 
     try:
-        result = router.ask_chat(messages, system=system_prompt, timeout=30)
+        if cached is not None:
+            result = {"ok": True, "text": cached}
+        else:
+            context_tokens = prompt.tokens + history_tokens + user_tokens
+            _history_record_context(context_tokens)
+            print(f"[WhatsApp] Contexto para {from_number}: {len(window)}/{len(history)} turnos, "
+                  f"~{context_tokens} tokens (prompt {prompt.tokens} + historial {history_tokens} + mensaje {user_tokens})")
+            result = router.ask_chat(messages, system=system_prompt, timeout=30)
+            if cache_key and result["ok"] and result["text"]:
+                _answer_cache_put(cache_key, result["text"])
+        # Soltar el request (y el media en base64) antes de procesar la respuesta
+        messages = user_msg = window = None
         if result["ok"]:
             reply = result["text"]
             if reply:
@@ -1488,43 +4063,31 @@ def _handle_wa_message(from_number, text, msg_id="", media_data=None, media_mime
             model = result.get("model", "?")
             key = result.get("key", "?")
             rpd = router.rpd_counts.get(key - 1, {}).get(model, "?") if isinstance(key, int) else "?"
-            print(f"[WhatsApp] Respondido con K{key}/{model} (RPD usado: {rpd}): {reply[:120]}")
-            # Separar por {{PAUSA:N}} para simular espera (ej: chequeo de pagos)
-            pausa_parts = re.split(r"\{\{PAUSA:(\d+)\}\}", reply)
-            # pausa_parts: [texto_antes, segundos, texto_despues, ...]
-            segments = []  # lista de (texto, delay_antes)
-            i = 0
-            while i < len(pausa_parts):
-                text_part = pausa_parts[i].strip()
-                if i == 0:
-                    if text_part:
-                        segments.append((text_part, 0))
-                else:
-                    # pausa_parts[i] es el delay, pausa_parts[i+1] es el texto
-                    delay_secs = int(pausa_parts[i])
-                    i += 1
-                    text_part = pausa_parts[i].strip() if i < len(pausa_parts) else ""
-                    if text_part:
-                        segments.append((text_part, delay_secs))
-                i += 1
-
-            for seg_text, seg_delay in segments:
-                if seg_delay > 0:
-                    _wa_typing(from_number, msg_id, wa_ctx)
-                    time.sleep(seg_delay)
-                # Dividir en varios mensajes para parecer natural
-                chunks = _split_reply(seg_text)
-                for j, chunk in enumerate(chunks):
-                    if j > 0:
-                        delay = min(0.5 + len(chunks[j - 1]) * 0.02, 3.0)
-                        _wa_typing(from_number, msg_id, wa_ctx)
-                        time.sleep(delay)
-                    _send_whatsapp(from_number, chunk, wa_ctx)
+            if cached is not None:
+                print(f"[WhatsApp] Respondido desde cache: {reply[:120]}")
+            else:
+                print(f"[WhatsApp] Respondido con K{key}/{model} (RPD usado: {rpd}): {reply[:120]}")
+            # Armar la línea de tiempo de entrega y devolver el worker al pool.
+            # El primer envío no sale antes del delay humano inicial.
+            events = _wa_plan_delivery(reply)
+            if not msg_id:
+                events = [e for e in events if e[1] != "typing"]
+            # Si el typing inicial todavía no salió (el LLM contestó dentro del delay
+            # humano, siempre en un hit del cache), pasa a ser el primer evento de la
+            # entrega: así se encola en la lane antes del primer chunk, no después
+            if msg_id and _scheduler.cancel_key(typing_key):
+                events.insert(0, (0, "typing", ""))
+            if events:
+                first_delay = max(events[0][0], ready_at - time.monotonic(), 0)
+                events[0] = (first_delay,) + events[0][1:]
+                _wa_deliver(from_number, msg_id, wa_ctx, events)
         else:
+            _scheduler.cancel_key(typing_key)
             _send_whatsapp(from_number, "Uh, tuve un error procesando tu mensaje. Probá de nuevo en un rato.", wa_ctx)
             print(f"[WhatsApp] Error de Gemini: {result.get('error')}")
     except Exception as e:
         print(f"[WhatsApp] Excepción procesando mensaje de {from_number}: {e}")
+        _scheduler.cancel_key(typing_key)
         _send_whatsapp(from_number, "Se me rompió algo, probá de nuevo.", wa_ctx)
 
 
@@ -1532,12 +4095,14 @@ def _handle_wa_media(from_number, media_id, msg_id="", media_label="audio", capt
     """Descarga media de WhatsApp y lo manda a Gemini en una sola request."""
     if msg_id:
         _wa_typing(from_number, msg_id, wa_ctx)
-    data, mime_type = _wa_download_media(media_id, wa_ctx)
-    if not data:
+    media = _wa_download_media(media_id, wa_ctx)
+    if media is None:
         _send_whatsapp(from_number, f"No pude recibir el {media_label}, me lo mandás de nuevo?", wa_ctx)
         return
-    print(f"[WhatsApp] {media_label.capitalize()} descargado: {len(data)} bytes, {mime_type}")
-    _handle_wa_message(from_number, caption, msg_id="", media_data=data, media_mime=mime_type, media_label=media_label, wa_ctx=wa_ctx)
+    print(f"[WhatsApp] {media_label.capitalize()} {'del cache' if media.from_cache else 'descargado'}: "
+          f"{media.size} bytes, {media.mime_type}")
+    _media_preprocess(media, wa_ctx)
+    _handle_wa_message(from_number, caption, msg_id="", media=media, media_label=media_label, wa_ctx=wa_ctx)
 
 
 class RenzoHandler(SimpleHTTPRequestHandler):
@@ -1579,6 +4144,9 @@ class RenzoHandler(SimpleHTTPRequestHandler):
         if path == "/api/admin/wa-numbers":
             self._handle_admin_wa_numbers_get()
             return
+        if path == "/api/admin/metrics":
+            self._handle_admin_metrics_get()
+            return
         # lola.*/app → onboarding, lola.*/ → landing
         host = self.headers.get("Host", "")
         if "lola" in host:
@@ -1662,27 +4230,18 @@ class RenzoHandler(SimpleHTTPRequestHandler):
                 # Identificar a qué tenant va este mensaje
                 phone_number_id = value.get("metadata", {}).get("phone_number_id", "")
 
-                # Buscar config del tenant en wa_numbers
-                wa_number = _db_wa_number_load(phone_number_id) if phone_number_id else None
-                if wa_number:
-                    tenant = _db_tenant_load_by_hash(wa_number["tenant_phone_hash"])
-                    wa_ctx = {
-                        "phone_number_id": phone_number_id,
-                        "access_token": wa_number["access_token"],
-                        "system_prompt": tenant["system_prompt"] if tenant and tenant.get("system_prompt") else LOLA_SALES_PROMPT,
-                        "tenant_phone": tenant["phone"] if tenant else "",
-                        "is_lola_sales": False,
-                    }
-                elif WA_CONFIG and phone_number_id == WA_CONFIG.get("phone_number_id", ""):
-                    # Es el número de ventas de Lola
-                    wa_ctx = {
-                        "phone_number_id": WA_CONFIG["phone_number_id"],
-                        "access_token": WA_CONFIG["access_token"],
-                        "system_prompt": LOLA_SALES_PROMPT,
-                        "tenant_phone": "",
-                        "is_lola_sales": True,
-                    }
-                else:
+                # Statuses (sent/delivered/read) y otros callbacks sin mensajes procesables
+                # no necesitan resolver el tenant: van directo al sink
+                if not _wa_webhook_has_messages(value):
+                    _wa_status_sink(phone_number_id, value)
+                    continue
+                with _wa_webhook_stats_lock:
+                    _wa_webhook_stats["changes"] += 1
+                    _wa_webhook_stats["message_changes"] += 1
+
+                # Resolver el contexto del tenant (tabla de routing precalculada)
+                wa_ctx = _wa_route(phone_number_id) if phone_number_id else None
+                if wa_ctx is None:
                     if phone_number_id:
                         print(f"[WhatsApp] phone_number_id desconocido: {phone_number_id}")
                     continue
@@ -1690,20 +4249,13 @@ class RenzoHandler(SimpleHTTPRequestHandler):
                 messages = value.get("messages", [])
                 for msg in messages:
                     msg_type = msg.get("type", "")
-                    if msg_type not in ("text", "audio", "image", "location"):
+                    if msg_type not in _WA_MSG_TYPES:
                         continue
                     msg_id = msg.get("id", "")
                     # Deduplicar — Meta reenvía si tarda
-                    now = time.time()
-                    if msg_id and msg_id in _wa_seen_ids:
+                    if msg_id and not _wa_seen_ids.add(msg_id):
                         print(f"[WhatsApp] Mensaje duplicado ignorado: {msg_id}")
                         continue
-                    if msg_id:
-                        _wa_seen_ids[msg_id] = now
-                        # Limpiar viejos
-                        expired = [k for k, v in _wa_seen_ids.items() if now - v > _WA_SEEN_TTL]
-                        for k in expired:
-                            del _wa_seen_ids[k]
                     from_number = msg.get("from", "")
                     if not from_number:
                         continue
@@ -1712,8 +4264,8 @@ class RenzoHandler(SimpleHTTPRequestHandler):
                     quote_prefix = ""
                     ctx = msg.get("context", {})
                     quoted_id = ctx.get("id", "")
-                    if quoted_id and quoted_id in _wa_msg_texts:
-                        quoted_text = _wa_msg_texts[quoted_id]
+                    quoted_text = _wa_quote_get(phone_number_id, quoted_id) if quoted_id else None
+                    if quoted_text:
                         quote_prefix = f"[respondiendo a: \"{quoted_text[:200]}\"]\n"
 
                     if msg_type == "text":
@@ -1722,7 +4274,7 @@ class RenzoHandler(SimpleHTTPRequestHandler):
                             continue
                         # Guardar texto entrante para futuros quote replies
                         if msg_id:
-                            _wa_msg_texts[msg_id] = text[:500]
+                            _wa_quote_put(phone_number_id, msg_id, text)
                         full_text = quote_prefix + text if quote_prefix else text
                         print(f"[WhatsApp] Mensaje de {from_number}: {text[:80]}")
                         _wa_queue_message(from_number, msg_id, {"type": "text", "text": full_text}, wa_ctx)
@@ -1804,15 +4356,9 @@ class RenzoHandler(SimpleHTTPRequestHandler):
                 msg_id = msg.get("mid", "")
 
                 # Deduplicar
-                now = time.time()
-                if msg_id and msg_id in _ig_seen_ids:
+                if msg_id and not _ig_seen_ids.add(msg_id):
                     print(f"[Instagram] Mensaje duplicado ignorado: {msg_id}")
                     continue
-                if msg_id:
-                    _ig_seen_ids[msg_id] = now
-                    expired = [k for k, v in _ig_seen_ids.items() if now - v > _IG_SEEN_TTL]
-                    for k in expired:
-                        del _ig_seen_ids[k]
 
                 text = msg.get("text", "")
                 if not text:
@@ -1876,7 +4422,7 @@ class RenzoHandler(SimpleHTTPRequestHandler):
 
         # Enviar por WhatsApp
         otp_msg = f"Tu código de verificación para Lola es: {code}\n\nNo lo compartas con nadie."
-        threading.Thread(target=_send_whatsapp, args=(phone, otp_msg), daemon=True).start()
+        _send_whatsapp(phone, otp_msg)
 
         via = f"sub:{sub_info.get('plan', '?')}" if has_sub else "pago"
         print(f"[Auth] OTP enviado a {phone} (via: {via})")
@@ -1932,7 +4478,6 @@ class RenzoHandler(SimpleHTTPRequestHandler):
         del _otp_pending[phone]
         token = os.urandom(16).hex()
         sub_info = _mp_check_subscription(phone)
-        tenant = _tenant_load(phone)
 
         now = time.time()
         _auth_sessions[token] = {
@@ -1941,7 +4486,7 @@ class RenzoHandler(SimpleHTTPRequestHandler):
             "plan": sub_info.get("plan", ""),
             "created": now,
             "last_active": now,
-            "onboarding_complete": tenant is not None and bool(tenant.get("system_prompt")),
+            "onboarding_complete": _db_tenant_has_prompt(phone),
         }
 
         print(f"[Auth] Sesión creada para {phone} (token: {token[:8]}...)")
@@ -1977,8 +4522,7 @@ class RenzoHandler(SimpleHTTPRequestHandler):
         session["last_active"] = time.time()
 
         # Re-chequear tenant por si se completó onboarding
-        tenant = _tenant_load(session["phone"])
-        session["onboarding_complete"] = tenant is not None and bool(tenant.get("system_prompt"))
+        session["onboarding_complete"] = _db_tenant_has_prompt(session["phone"])
 
         self._json_response({
             "ok": True,
@@ -2130,21 +4674,10 @@ class RenzoHandler(SimpleHTTPRequestHandler):
                 hist_key = session_id
                 system_prompt = LOLA_SALES_PROMPT
 
-            # Obtener/crear historial
-            now = time.time()
+            # Obtener historial (se rehidrata de SQLite si no está en memoria)
             if body.get("reset"):
-                _lola_web_history.pop(hist_key, None)
-            entry = _lola_web_history.get(hist_key)
-            if entry and (now - entry["ts"]) > _LOLA_WEB_HISTORY_TTL:
-                del _lola_web_history[hist_key]
-                entry = None
-
-            if not entry:
-                _lola_web_history[hist_key] = {"messages": [], "ts": now}
-                entry = _lola_web_history[hist_key]
-
-            entry["ts"] = now
-            history = entry["messages"]
+                _conv_reset("web", hist_key)
+            history = _conv_get("web", hist_key, _LOLA_WEB_HISTORY_TTL)
 
             # Construir mensajes para ask_chat
             user_msg = {"role": "user", "text": text}
@@ -2167,19 +4700,24 @@ class RenzoHandler(SimpleHTTPRequestHandler):
                 if parts:
                     user_msg["parts"] = parts
 
-            messages = history + [user_msg]
+            # Ventana de historial: el presupuesto descuenta el mensaje actual y los
+            # adjuntos de texto (un CSV pegado cuenta lo que pesa)
+            user_tokens = _turn_tokens_estimate(text) + sum(
+                _estimate_tokens(p["text"]) for p in user_msg.get("parts", ()) if "text" in p)
+            window, history_tokens = _history_window(history, _HISTORY_TOKENS, reserved=user_tokens)
+            messages = window + [user_msg]
+            context_tokens = _estimate_tokens(system_prompt) + history_tokens + user_tokens
+            _history_record_context(context_tokens)
+            print(f"[Lola Chat] Contexto: {len(window)}/{len(history)} turnos, ~{context_tokens} tokens")
 
             result = router.ask_chat(messages, system=system_prompt, timeout=30)
 
             if result["ok"]:
                 reply = result["text"]
 
-                # Guardar en historial
-                entry["messages"].append({"role": "user", "text": text})
-                entry["messages"].append({"role": "model", "text": reply})
-                # Recortar historial
-                while len(entry["messages"]) > _LOLA_WEB_HISTORY_MAX:
-                    entry["messages"].pop(0)
+                # Guardar en historial (guarda hasta _LOLA_WEB_HISTORY_MAX turnos)
+                _conv_append("web", hist_key, "user", text, _LOLA_WEB_HISTORY_TTL, _LOLA_WEB_HISTORY_MAX)
+                _conv_append("web", hist_key, "model", reply, _LOLA_WEB_HISTORY_TTL, _LOLA_WEB_HISTORY_MAX)
 
                 # Detectar onboarding completo
                 onboarding_done = False
@@ -2187,7 +4725,8 @@ class RenzoHandler(SimpleHTTPRequestHandler):
                     # Limpiar el tag de la respuesta visible
                     reply = reply.replace("{{onboarding_complete}}", "").strip()
                     # Procesar en background
-                    onboarding_done = _process_onboarding_complete(session, entry["messages"])
+                    onboarding_done = _process_onboarding_complete(
+                        session, _conv_get("web", hist_key, _LOLA_WEB_HISTORY_TTL))
 
                 self._json_response({
                     "text": reply,
@@ -2361,8 +4900,7 @@ class RenzoHandler(SimpleHTTPRequestHandler):
 
         # Si pasaron email, buscar el mp_id en subscribers
         if not mp_id and email:
-            subs = _mp_load_subscribers()
-            sub = subs.get(email)
+            sub = _db_subscriber_load(email)
             if sub:
                 mp_id = sub.get("mp_id", "")
             if not mp_id:
@@ -2375,13 +4913,8 @@ class RenzoHandler(SimpleHTTPRequestHandler):
 
         resp = _mp_api("PUT", f"/preapproval/{mp_id}", {"status": "cancelled"})
         if resp["ok"]:
-            # Actualizar subscribers
-            subs = _mp_load_subscribers()
-            for e, s in subs.items():
-                if s.get("mp_id") == mp_id:
-                    s["status"] = "cancelled"
-                    break
-            _mp_save_subscribers(subs)
+            # Actualizar solo la fila de este subscriber
+            _db_subscriber_set_status(mp_id, "cancelled")
             self._json_response({"ok": True, "status": "cancelled", "mp_id": mp_id})
             print(f"[MercadoPago] Suscripción cancelada: {mp_id}")
         else:
@@ -2481,8 +5014,7 @@ class RenzoHandler(SimpleHTTPRequestHandler):
 
             # Si no vino phone de MP, buscar en subscribers existentes
             if not phone and email:
-                existing = _db_subscribers_load()
-                ex = existing.get(email, {})
+                ex = _db_subscriber_load(email) or {}
                 phone = ex.get("phone", "")
 
             _db_subscriber_upsert(email, {
@@ -2515,6 +5047,32 @@ class RenzoHandler(SimpleHTTPRequestHandler):
         numbers = _db_wa_numbers_list()
         self._json_response({"wa_numbers": numbers})
 
+    def _handle_admin_metrics_get(self):
+        """GET /api/admin/metrics — Métricas internas (DB, caches, colas)."""
+        if not _require_admin(self):
+            return
+        self._json_response({
+            "db": _db_metrics(),
+            "tenant_cache": _tenant_cache.stats(),
+            "wa_routes": _wa_routes_metrics(),
+            "conversations": _conv_metrics(),
+            "wa_pool": _wa_pool.stats(),
+            "scheduler": _scheduler.stats(),
+            "http": _http_metrics(),
+            "wa_outbox": _wa_outbox.stats(),
+            "wa_governor": _wa_governor.stats(),
+            "dedup": {"wa": _wa_seen_ids.stats(), "ig": _ig_seen_ids.stats()},
+            "wa_quotes": _wa_quote_metrics(),
+            "media": _media_metrics(),
+            "media_cache": _media_cache_metrics(),
+            "media_preprocess": _media_preprocess_metrics(),
+            "wa_webhook": _wa_webhook_metrics(),
+            "answer_cache": _answer_cache_metrics(),
+            "prompts": _prompt_metrics(),
+            "history": _history_metrics(),
+            "wa_send_pool": _wa_send_pool.stats(),
+        })
+
     def _handle_admin_wa_numbers_post(self):
         """POST /api/admin/wa-numbers — Registra un número de WhatsApp para un tenant."""
         if not _require_admin(self):
@@ -2531,6 +5089,17 @@ class RenzoHandler(SimpleHTTPRequestHandler):
         access_token = body.get("access_token", "").strip()
         business_account_id = body.get("business_account_id", "").strip()
         label = body.get("label", "").strip()
+        media_preprocess = _parse_flag(body.get("media_preprocess", True))
+        if media_preprocess is None:
+            self._json_response({"error": "media_preprocess inválido (true/false)"}, 400)
+            return
+        try:
+            history_tokens = int(body.get("history_tokens") or 0)
+        except (TypeError, ValueError):
+            history_tokens = -1
+        if not 0 <= history_tokens <= _HISTORY_TOKENS_MAX:
+            self._json_response({"error": f"history_tokens inválido (0 = default, máximo {_HISTORY_TOKENS_MAX})"}, 400)
+            return
 
         if not phone_number_id or not access_token:
             self._json_response({"error": "Faltan phone_number_id y/o access_token"}, 400)
@@ -2541,19 +5110,26 @@ class RenzoHandler(SimpleHTTPRequestHandler):
             tenant_phone = _normalize_phone(tenant_phone)
             tenant_phone_hash = _hash_key(tenant_phone)
 
-        _db_wa_number_save(phone_number_id, {
+        saved = _db_wa_number_save(phone_number_id, {
             "tenant_phone_hash": tenant_phone_hash,
             "access_token": access_token,
             "business_account_id": business_account_id,
             "label": label,
             "status": "active",
-        })
+            "media_preprocess": media_preprocess,
+            "history_tokens": history_tokens,
+        }).wait()
+        if not saved:
+            self._json_response({"error": "No se pudo guardar el número"}, 500)
+            return
 
         self._json_response({
             "ok": True,
             "phone_number_id": phone_number_id,
             "label": label,
             "tenant_phone": tenant_phone,
+            "media_preprocess": media_preprocess,
+            "history_tokens": history_tokens,
         })
 
     def _handle_mp_get_subscribers(self):
@@ -2596,7 +5172,14 @@ def main():
     server = ThreadingHTTPServer(("0.0.0.0", port), RenzoHandler)
     print(f"🚀 RenzoGPT corriendo en http://0.0.0.0:{port}")
     print(f"   Router: {len(router.keys)} keys × {len(router.models)} modelos")
+    _db_migrate_from_json()
     wa_num_count = _db_wa_numbers_count()
+    routes = _wa_routes_rebuild()
+    _conv_purge_expired()
+    _wa_quote_purge_expired()
+    media_cached = _media_cache_load()
+    print(f"   Routing WhatsApp: {routes} números precargados")
+    print(f"   Cache de media: {media_cached} archivos")
     print(f"   WhatsApp: {'habilitado' if WA_CONFIG else 'deshabilitado'} ({wa_num_count} números de tenants)")
     print(f"   MercadoPago: {'habilitado' if MP_CONFIG else 'deshabilitado'}")
     print(f"   Instagram: {'habilitado' if IG_CONFIG else 'deshabilitado'}")
@@ -2606,6 +5189,7 @@ def main():
     except KeyboardInterrupt:
         print("\n👋 RenzoGPT apagado.")
         server.server_close()
+        _db_writer_flush()
 
 
 if __name__ == "__main__":